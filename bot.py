@@ -1,3 +1,4 @@
+from teslcardbot.cache import LRUCache
 import requests
 import random
 import json
@@ -19,6 +20,9 @@ class Card:
     KEYWORDS = ['Prophecy', 'Breakthrough', 'Guard', 'Regenerate', 'Charge', 'Ward', 'Shackle',
                 'Lethal', 'Pilfer', 'Last Gasp', 'Summon', 'Drain']
     PARTIAL_MATCH_END_LENGTH = 20
+    ROW_TEMPLATE = '[📷]({url} "{text}") {name} ' \
+                   '| {type} | {stats} | {keywords} | {attrs} | {unique}{rarity}'
+    RENDER_CACHE = LRUCache(max_size=512)
 
     @staticmethod
     def preload_card_data(path='data/cards.json'):
@@ -145,9 +149,19 @@ class Card:
         self.keywords = Card._extract_keywords(text)
 
     def __str__(self):
-        template = '[📷]({url} "{text}") {name} ' \
-                   '| {type} | {stats} | {keywords} | {attrs} | {unique}{rarity}'
-
+        key = self._render_key()
+        row = Card.RENDER_CACHE.get(key)
+        if row is None:
+            row = self._render()
+            Card.RENDER_CACHE.set(key, row)
+        return row
+
+    def _render_key(self):
+        # Everything the rendered row depends on
+        return (self.ROW_TEMPLATE, self.name, self.img_url, self.type, tuple(self.attributes), self.rarity,
+                self.unique, self.cost, self.power, self.health, self.text, tuple(self.keywords))
+
+    def _render(self):
         def _format_stats(t):
             if self.type == 'creature':
                 return t.format(self.cost, self.power, self.health)
@@ -156,7 +170,7 @@ class Card:
             else:
                 return t.format(self.cost, '?', '?')
 
-        return template.format(
+        return self.ROW_TEMPLATE.format(
             attrs='/'.join(map(str, self.attributes)),
             unique='' if not self.unique else 'Unique ',
             rarity=self.rarity.title(),
@@ -0,0 +1,45 @@
+from teslcardbot.bot import TESLCardBot
+from teslcardbot.card import remove_duplicates
+import timeit
+
+
+def regex_mentions(s):
+    return remove_duplicates(TESLCardBot.CARD_MENTION_REGEX.findall(s))
+
+
+def capped(mentions):
+    mentions = [m for m in mentions if len(m) <= TESLCardBot.MAX_MENTION_LENGTH]
+    return mentions[:TESLCardBot.MAX_MENTIONS]
+
+
+# (name, text, whether the old regex finishes on it in a reasonable time)
+CASES = [
+    ('no mentions', 'Just a regular comment about the meta, nothing to see here. ' * 20, True),
+    ('few mentions', 'I like {{Tyr}} and {{Lesser Ward}}, but {{Dawnbreaker}} is better. ' * 5, True),
+    ('many mentions', ' '.join('{{{{Card {}}}}}'.format(i) for i in range(200)), True),
+    ('unbalanced braces', '{{' * 2000 + '}}', True),
+    ('unclosed mention (short)', '{{' + 'a' * 18, True),
+    # The nested lazy quantifier makes the regex backtrack exponentially on this one
+    ('unclosed mention (long)', '{{' + 'a' * 100000, False),
+    ('mentions across lines', '{{Tyr\n}}' * 2000, True),
+    # Lots of mentions cut short by a newline before a single closing pair
+    ('unclosed mentions across lines', '{{\n' * 80000 + '}}', True),
+]
+
+
+def bench(f, text, number):
+    return min(timeit.repeat(lambda: f(text), number=number, repeat=3)) / number
+
+
+def main(number=100):
+    print('{:<28} {:>14} {:>14}'.format('case', 'regex (us)', 'scanner (us)'))
+    for name, text, regex_ok in CASES:
+        if regex_ok:
+            assert capped(regex_mentions(text)) == TESLCardBot.find_card_mentions(text)
+        regex = '{:14.2f}'.format(bench(regex_mentions, text, number) * 1e6) if regex_ok else '{:>14}'.format('-')
+        scanner = bench(TESLCardBot.find_card_mentions, text, number) * 1e6
+        print('{:<28} {} {:14.2f}'.format(name, regex, scanner))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+from teslcardbot.bot import TESLCardBot
+from teslcardbot.card import Card
+from teslcardbot.cache import ImageCache, LRUCache
+import subprocess
+import argparse
+import platform
+import random
+import json
+import time
+
+WORDS = ['the', 'deck', 'is', 'good', 'but', 'I', 'think', 'you', 'need', 'more', 'removal', 'and', 'card', 'draw',
+         'arena', 'ranked', 'legend', 'meta', 'lane', 'rune', 'prophecy', 'guard', 'lol', 'what', 'about']
+
+
+def fake_check_img(url):
+    # Stands in for the image host, so that nothing here touches the network
+    return not url.endswith('z.png')
+
+
+def make_mention(rng):
+    name = rng.choice(Card.JSON_DATA)['name']
+    kind = rng.random()
+    if kind < 0.5:
+        return name
+    elif kind < 0.7:
+        return name.lower()
+    elif kind < 0.9:
+        # Partial match
+        return name[:rng.randint(3, max(3, len(name)))]
+    # Typo
+    i = rng.randrange(len(name))
+    return name[:i] + name[i + 1:]
+
+
+def make_comment(rng, words, density):
+    tokens = []
+    for _ in range(words):
+        if rng.random() < density:
+            tokens.append('{{{{{}}}}}'.format(make_mention(rng)))
+        else:
+            tokens.append(rng.choice(WORDS))
+    return ' '.join(tokens)
+
+
+def make_corpus(rng, count, words, density):
+    return [make_comment(rng, words, density) for _ in range(count)]
+
+
+def measure(f, inputs):
+    timings = []
+    for x in inputs:
+        start = time.perf_counter()
+        f(x)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    total = sum(timings)
+    return {'calls': len(timings),
+            'ops_per_sec': len(timings) / total if total > 0 else float('inf'),
+            'p50_us': timings[len(timings) // 2] * 1e6,
+            'p99_us': timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(seed=0, scale=1):
+    rng = random.Random(seed)
+    Card.preload_card_data()
+    Card._check_img = staticmethod(fake_check_img)
+    names = [c['name'] for c in Card.JSON_DATA]
+    queries = [make_mention(rng) for _ in range(2000 * scale)]
+    texts = [c['text'] for c in Card.JSON_DATA]
+
+    results = {}
+    results['escape_name'] = measure(Card._escape_name, names * scale)
+    results['fetch_data_partial'] = measure(Card._fetch_data_partial, queries)
+    results['extract_keywords'] = measure(Card._extract_keywords, texts * scale)
+
+    # Cold runs go through the (fake) image check, warm runs hit the image cache
+    Card.IMAGE_CACHE = ImageCache()
+    results['get_info_cold'] = measure(Card.get_info, queries)
+    results['get_info_warm'] = measure(Card.get_info, queries)
+
+    bot = TESLCardBot(author='Benchmark', target_sub='Benchmark')
+    for words in [20, 200, 2000]:
+        for density in [0.0, 0.01, 0.05]:
+            corpus = make_corpus(rng, max(10, 20000 * scale // words), words, density)
+            key = '{}w_{}d'.format(words, density)
+            results['find_card_mentions_' + key] = measure(TESLCardBot.find_card_mentions, corpus)
+            mentions = [m for m in map(TESLCardBot.find_card_mentions, corpus) if len(m) > 0]
+            if len(mentions) > 0:
+                Card.RENDER_CACHE = LRUCache(max_size=512)
+                results['build_response_' + key] = measure(bot.build_response, mentions)
+
+    return {'meta': {'commit': git_commit(),
+                     'python': platform.python_version(),
+                     'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'seed': seed,
+                     'scale': scale},
+            'results': results}
+
+
+def report(results, baseline=None):
+    print('{:<40} {:>8} {:>14} {:>12} {:>12}'.format('benchmark', 'calls', 'ops/s', 'p50 (us)', 'p99 (us)'))
+    for name, r in sorted(results['results'].items()):
+        line = '{:<40} {:>8} {:>14.1f} {:>12.2f} {:>12.2f}'.format(name, r['calls'], r['ops_per_sec'],
+                                                                   r['p50_us'], r['p99_us'])
+        if baseline is not None and name in baseline['results']:
+            old = baseline['results'][name]
+            line += '  {:+.1%} p50'.format(r['p50_us'] / old['p50_us'] - 1 if old['p50_us'] > 0 else 0)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the card lookup and reply building hot paths.')
+    parser.add_argument('-o', '--output', default=None, help='Where should the results be saved as JSON?')
+    parser.add_argument('-c', '--compare', default=None, help='Results of a previous run to compare against.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic comments.')
+    parser.add_argument('--scale', type=int, default=1, help='Multiplies the size of every corpus.')
+    args = parser.parse_args()
+
+    results = run(seed=args.seed, scale=args.scale)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
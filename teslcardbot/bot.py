@@ -1,223 +1,141 @@
-import requests
+from teslcardbot.card import Card, CACHES, remove_duplicates
+from teslcardbot.query import QueryResult
+from teslcardbot.cache import LRUCache
+from teslcardbot.seen import SeenSet
+from teslcardbot.checkpoint import Checkpoint
+from teslcardbot.fetcher import StreamFetcher
+from teslcardbot.metrics import STAGE_SECONDS, POLL_LAG_SECONDS, ITEMS_PROCESSED, REPLIES_POSTED, ERRORS, \
+    register_seen_metrics
+from concurrent.futures import ThreadPoolExecutor
 import random
-import json
-import praw
+import signal
+import time
+import sys
 import re
 import os
 
 
-def remove_duplicates(seq):
-    seen = set()
-    seen_add = seen.add
-    return [x for x in seq if not (x in seen or seen_add(x))]
-
-
-class Card:
-    CARD_IMAGE_BASE_URL = 'http://www.legends-decks.com/img_cards/{}.png'
-    CARD_IMAGE_404_URL = 'http://imgur.com/1Lxy3DA'
-    JSON_DATA = []
-    KEYWORDS = ['Prophecy', 'Breakthrough', 'Guard', 'Regenerate', 'Charge', 'Ward', 'Shackle',
-                'Lethal', 'Pilfer', 'Last Gasp', 'Summon', 'Drain']
-    PARTIAL_MATCH_END_LENGTH = 20
-
-    @staticmethod
-    def preload_card_data(path='data/cards.json'):
-        dir = os.path.dirname(__file__)
-        filename = os.path.join(dir, path)
-
-        with open(filename) as f:
-            Card.JSON_DATA = json.load(f)
-
-    @staticmethod
-    def _escape_name(card):
-        return re.sub(r'[\s_\-"\',;{\}]', '', card).lower()
-
-    @staticmethod
-    def _img_exists(url):
-        req = requests.get(url)
-        return req.headers['content-type'] == 'image/png'
-
-    @staticmethod
-    def _extract_keywords(text):
-        expr = re.compile(r'((?<!Gasp:\s)\w+(?:\sGasp)?)', re.I)
-        # If the card is an item, remove the +x/+y from its text.
-        text = re.sub(r'\+\d/\+\d', '', text)
-        words = expr.findall(text)
-        # Keywords are extracted until a non-keyword word is found
-        keywords = []
-        for word in words:
-            word = word.title()
-            if word in Card.KEYWORDS:
-                keywords.append(word)
-            else:
-                break
-        return remove_duplicates(keywords)
-
-    @staticmethod
-    def _fetch_data_partial(name):
-        i = 0
-        matches = ['', '']
-        while len(matches) > 1 and i <= Card.PARTIAL_MATCH_END_LENGTH:
-            matches = [s for s in Card.JSON_DATA if Card._escape_name(s['name']).startswith(Card._escape_name(name[:i]))]
-            i += 1
-
-        if len(matches) == 0:
-            return None
-
-        match = matches[0]
-        if Card._escape_name(match['name'])[:len(name)] == Card._escape_name(name):
-            return match
-        return None
-
-    @staticmethod
-    def get_info(name):
-        name = Card._escape_name(name)
-
-        if name == 'teslcardbot':  # I wonder...
-            return Card('TESLCardBot', 'https://imgs.xkcd.com/comics/tabletop_roleplaying.png',
-                        type='Bot',
-                        attribute_1='Python',
-                        attribute_2='JSON',
-                        rarity='Legendary',
-                        text='If your have more health than your opponent, win the game.',
-                        cost='∞', power='∞', health='∞')
-
-        # If JSON_DATA hasn't been populated yet, try to do it now or fail miserably.
-        if len(Card.JSON_DATA) <= 0:
-            Card.preload_card_data()
-            assert (len(Card.JSON_DATA) > 0)
-
-        data = Card._fetch_data_partial(name)
-
-        if data is None:
-            return None
-
-        img_url = Card.CARD_IMAGE_BASE_URL.format(Card._escape_name(data['name']))
-        # Unlikely, but possible?
-        if not Card._img_exists(img_url):
-            img_url = Card.CARD_IMAGE_404_URL
-
-        name = data['name']
-        type = data['type']
-        attr_1 = data['attribute_1']
-        attr_2 = data['attribute_2']
-        rarity = data['rarity']
-        unique = data['isunique'] == 'true'
-        cost = int(data['cost'])
-        text = data['text']
-        power = ''
-        health = ''
-        if type == 'creature':
-            power = int(data['attack'])
-            health = int(data['health'])
-        elif type == 'item':
-            # Stats granted by items are extracted from their text
-            stats = re.findall(r'\+(\d)/\+(\d)', text)
-            power, health = stats[0]
-
-        return Card(name=name,
-                    img_url=img_url,
-                    type=type,
-                    attribute_1=attr_1,
-                    attribute_2=attr_2,
-                    rarity=rarity,
-                    unique=unique,
-                    cost=cost,
-                    power=power,
-                    health=health,
-                    text=text)
-
-    def __init__(self, name, img_url, type='Creature', attribute_1='neutral',
-                 attribute_2='', text='', rarity='Common', unique=False, cost=0, power=0, health=0):
-        self.name = name
-        self.img_url = img_url
-        self.type = type
-        self.attributes = [attribute_1.title(), attribute_2.title()] if len(attribute_2) > 0 else [attribute_1.title()]
-        self.rarity = rarity
-        self.unique = unique
-        self.cost = cost
-        self.power = power
-        self.health = health
-        self.text = text
-        self.keywords = Card._extract_keywords(text)
-
-    def __str__(self):
-        template = '[📷]({url}) {name} ' \
-                   '| {type} | {stats} | {keywords} | {attrs} | {unique}{rarity} | {text}'
-
-        def _format_stats(t):
-            if self.type == 'creature':
-                return t.format(self.cost, self.power, self.health)
-            elif self.type == 'item':
-                return t.format(self.cost, '+{}'.format(self.power), '+{}'.format(self.health))
-            else:
-                return t.format(self.cost, '?', '?')
-
-        return template.format(
-            attrs='/'.join(map(str, self.attributes)),
-            unique='' if not self.unique else 'Unique ',
-            rarity=self.rarity.title(),
-            name=self.name,
-            url=self.img_url,
-            type=self.type.title(),
-            mana=self.cost,
-            stats=_format_stats('{} - {}/{}'),
-            keywords=', '.join(map(str, self.keywords)) + '' if len(self.keywords) > 0 else 'None',
-            text=self.text if len(self.text) > 0 else 'This card\'s name isn\'t in the database. Possible typo?'
-        )
+def exit_on_sigterm():
+    # Heroku and the supervisor stop the bot with SIGTERM, which would skip every finally block and atexit handler
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 
 class TESLCardBot:
+    # What find_card_mentions matches, without the backtracking
     CARD_MENTION_REGEX = re.compile(r'\{\{((?:.*?)+)\}\}')
+    MAX_MENTIONS = 20
+    MAX_MENTION_LENGTH = 100
+    # Mentions like {{? 3-cost willpower creatures with guard}} search for cards instead of naming one
+    QUERY_PREFIX = '?'
+    MAX_QUERIES = 3
+    MAX_QUERY_RESULTS = 10
+    # The most Reddit returns in a single page
+    COMMENTS_PAGE_SIZE = 100
+    # Rendered tables by the cards they're made of, so busy threads asking for the same cards are cheap to reply to
+    RESPONSE_CACHE = LRUCache(max_size=256, ttl=600)
 
     @staticmethod
     def find_card_mentions(s):
-        return remove_duplicates(TESLCardBot.CARD_MENTION_REGEX.findall(s))
+        mentions = []
+        seen = set()
+        # Most comments don't mention any card at all
+        i = s.find('{{')
+        end = -1
+        while i >= 0 and len(mentions) < TESLCardBot.MAX_MENTIONS:
+            # The closing braces found last time are still the first ones after i, unless i went past them. Searching
+            # again from every '{{' would make lots of them before a single '}}' quadratic.
+            if end < i + 2:
+                end = s.find('}}', i + 2)
+            if end < 0:
+                break
+            newline = s.find('\n', i + 2, end)
+            if newline >= 0:
+                # Mentions can't span multiple lines, and none can start before this newline and end after it
+                i = s.find('{{', newline + 1)
+                continue
+            mention = s[i + 2:end]
+            if len(mention) <= TESLCardBot.MAX_MENTION_LENGTH and mention not in seen:
+                seen.add(mention)
+                mentions.append(mention)
+            i = s.find('{{', end + 2)
+        return mentions
+
+    @staticmethod
+    def _is_query(mention):
+        return mention.lstrip().startswith(TESLCardBot.QUERY_PREFIX)
 
     def _get_praw_instance(self):
+        import praw
         r = praw.Reddit('TES:L Card Fetcher by /u/{}.'.format(self.author))
         r.login(username=os.environ['REDDIT_USERNAME'], password=os.environ['REDDIT_PASSWORD'], disable_warning=True)
         return r
 
-    def _process_submission(self, s):
+    def _submission_mentions(self, s):
         cards = TESLCardBot.find_card_mentions(s.selftext)
         if len(cards) > 0 and not s.saved:
-            try:
-                self.log('Commenting in {} about the following cards: {}'.format(s.title, cards))
-                response = self.build_response(cards)
-                s.add_comment(response)
-                s.save()
-                self.log('Done commenting and saved thread.')
-            except:
-                self.log('There was an error while trying to leave a comment.')
-                raise
+            return cards
+        return []
 
-    def _process_comment(self, c):
+    def _comment_mentions(self, c):
         cards = TESLCardBot.find_card_mentions(c.body)
         if len(cards) > 0 and not c.saved and c.author != os.environ['REDDIT_USERNAME']:
-            try:
+            return cards
+        return []
+
+    def _post_reply(self, kind, item, response):
+        # Only posts the reply, the reply queue saves the item once this went through
+        try:
+            with STAGE_SECONDS.time(stage='reply'):
+                if kind == 'submission':
+                    item.add_comment(response)
+                else:
+                    item.reply(response)
+            REPLIES_POSTED.inc(kind=kind)
+        except:
+            ERRORS.inc(stage='reply')
+            self.log('There was an error while trying to reply.')
+            raise
+
+    @staticmethod
+    def _observe_item(kind, item):
+        ITEMS_PROCESSED.inc(kind=kind)
+        created = getattr(item, 'created_utc', None)
+        if created is not None:
+            POLL_LAG_SECONDS.observe(max(0, time.time() - created), kind=kind)
+
+    def _process_submission(self, s):
+        TESLCardBot._observe_item('submission', s)
+        with STAGE_SECONDS.time(stage='process_submission'):
+            cards = self._submission_mentions(s)
+            if len(cards) > 0:
+                self.log('Commenting in {} about the following cards: {}'.format(s.title, cards))
+                self.replies.put('submission', s, cards, self.build_response(cards))
+                return True
+        return False
+
+    def _process_comment(self, c):
+        TESLCardBot._observe_item('comment', c)
+        with STAGE_SECONDS.time(stage='process_comment'):
+            cards = self._comment_mentions(c)
+            if len(cards) > 0:
                 self.log('Replying to {} about the following cards: {}'.format(c.id, cards))
-                response = self.build_response(cards)
-                c.reply(response)
-                c.save()
-                self.log('Done replying and saved comment.')
-            except:
-                self.log('There was an error while trying to reply.')
-                raise
+                self.replies.put('comment', c, cards, self.build_response(cards))
+                return True
+        return False
 
-    # TODO: Make this template-able, maybe?
     def build_response(self, cards):
-        response = 'Name | Type | Stats | Keywords | Attribute | ' \
-                   'Rarity | Text \n--|--|--|--|--|--|--|--\n'
+        with STAGE_SECONDS.time(stage='build_response'):
+            return self._build_response(cards)
 
-        cards_not_found = []
-
-        for name in cards:
-            card = Card.get_info(name)
-            if card is None:
-                cards_not_found.append(name)
-            else:
-                response += '{}\n'.format(str(card))
+    # TODO: Make this template-able, maybe?
+    def _build_response(self, cards):
+        resolved = self._resolve_cards(cards)
+        # Anything that ends up in the body, cards that weren't found are listed by the name they were mentioned by
+        key = tuple(TESLCardBot._response_key(name, card) for name, card in zip(cards, resolved))
+        response = TESLCardBot.RESPONSE_CACHE.get(key)
+        if response is None:
+            response = self._build_response_body(cards, resolved)
+            TESLCardBot.RESPONSE_CACHE.set(key, response)
 
         did_you_know = random.choice(['You can hover the camera emoji to read a card\'s text!',
                                       'I can do partial matches!',
@@ -230,13 +148,6 @@ class TESLCardBot:
                                       ])
         auto_word = random.choice(['automatically', 'automagically'])
 
-        if len(cards_not_found) == len(cards):
-            response = 'I\'m sorry, but none of the cards you mentioned were matched. ' \
-                       'Tokens and other generated cards will be included soon.\n'
-        elif len(cards_not_found) > 0:
-            response += '\n^(Some of the cards you mentioned were not matched: _{}._ ' \
-                        'Tokens and other generated cards will be included soon.)\n'.format(', '.join(cards_not_found))
-
         response += '\n**Did you know?** _{}_\n\n' \
                     '\n\n&nbsp;\n\n^(_I am a bot, and this action was performed {}. Made by user G3Kappa. ' \
                     'Special thanks to Jeremy at legends-decks._)' \
@@ -244,10 +155,96 @@ class TESLCardBot:
                     'message/compose/?to={})'.format(did_you_know, auto_word, self.author)
         return response
 
+    @staticmethod
+    def _response_key(name, card):
+        if isinstance(card, QueryResult):
+            return ('query', card.query, tuple(c._render_key() for c in card.cards), card.total, card.error)
+        return ('card', card._render_key()) if card is not None else ('missing', name)
+
+    @staticmethod
+    def _query_note(result):
+        if result.error is not None:
+            return 'I couldn\'t understand _{}_. {}'.format(result.query, result.error)
+        if result.total == 0:
+            return 'No cards match _{}_.'.format(result.query)
+        if result.total > len(result.cards):
+            return 'Showing {} of the {} cards that match _{}_.'.format(len(result.cards), result.total, result.query)
+        return None
+
+    @staticmethod
+    def _build_response_body(cards, resolved):
+        response = 'Name | Type | Stats | Keywords | Attribute | ' \
+                   'Rarity | Text \n--|--|--|--|--|--|--|--\n'
+
+        cards_not_found = []
+        notes = []
+        rows = 0
+
+        for name, card in zip(cards, resolved):
+            if isinstance(card, QueryResult):
+                for found in card.cards:
+                    response += '{}\n'.format(str(found))
+                rows += len(card.cards)
+                note = TESLCardBot._query_note(card)
+                if note is not None:
+                    notes.append(note)
+            elif card is None:
+                cards_not_found.append(name)
+            else:
+                response += '{}\n'.format(str(card))
+                rows += 1
+
+        if rows == 0:
+            # Don't bother with an empty table, queries that found nothing explain themselves below
+            response = ''
+            if len(cards_not_found) > 0:
+                response = 'I\'m sorry, but none of the cards you mentioned were matched. ' \
+                           'Tokens and other generated cards will be included soon.\n'
+        elif len(cards_not_found) > 0:
+            response += '\n^(Some of the cards you mentioned were not matched: _{}._ ' \
+                        'Tokens and other generated cards will be included soon.)\n'.format(', '.join(cards_not_found))
+        for note in notes:
+            response += '\n^({})\n'.format(note)
+        return response
+
+    def _resolve_cards(self, cards):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.lookup_workers)
+
+        # Images that aren't checked within lookup_timeout, for the whole comment, are left unchecked
+        deadline = time.time() + self.lookup_timeout if self.lookup_timeout is not None else None
+
+        def remaining():
+            return max(0, deadline - time.time()) if deadline is not None else None
+
+        with STAGE_SECONDS.time(stage='get_info'):
+            names = [card for card in cards if not TESLCardBot._is_query(card)]
+            found = iter(Card.get_info_many(names, executor=self._executor, timeout=remaining()))
+            resolved = []
+            queries = 0
+            for card in cards:
+                if not TESLCardBot._is_query(card):
+                    resolved.append(next(found))
+                    continue
+                query = card.lstrip()[len(TESLCardBot.QUERY_PREFIX):].strip()
+                queries += 1
+                if queries > TESLCardBot.MAX_QUERIES:
+                    # Keeps the reply under Reddit's length limit
+                    resolved.append(QueryResult(query, [], 0, 'I only search for {} things per comment.'.format(
+                        TESLCardBot.MAX_QUERIES)))
+                else:
+                    resolved.append(Card.search(query, limit=TESLCardBot.MAX_QUERY_RESULTS, executor=self._executor,
+                                                timeout=remaining()))
+            return resolved
+
     def log(self, msg):
         print('TESLCardBot # {}'.format(msg))
 
-    def start(self, batch_limit=10, buffer_size=1000):
+    def start(self, batch_limit=10, buffer_size=1000, seen_path=None, checkpoint_path=None):
+        # Only the bot itself talks to Reddit, looking cards up doesn't need any of this
+        from teslcardbot.replies import ReplyQueue
+        import praw
+
         r = None
         try:
             r = self._get_praw_instance()
@@ -256,30 +253,103 @@ class TESLCardBot:
             self.log(e)
             return
 
-        already_done = []
+        already_done = TESLCardBot._progress(buffer_size, seen_path, checkpoint_path)
+        register_seen_metrics(already_done)
         subreddit = r.get_subreddit(self.target_sub)
+        # Replies are posted from their own thread, so that being rate limited doesn't hold up polling
+        self.replies = ReplyQueue(self, on_done=lambda item: already_done.add(item.id),
+                                  on_queued=already_done.add_pending if checkpoint_path is not None else None).start()
+        try:
+            if checkpoint_path is not None:
+                self._resume_replies(r, already_done)
+            self._poll(r, subreddit, batch_limit, already_done)
+        finally:
+            self.replies.stop()
+            already_done.save()
+            Card.IMAGE_CACHE.flush()
+
+    @staticmethod
+    def _progress(buffer_size, seen_path=None, checkpoint_path=None):
+        # The oldest ids are forgotten once buffer_size is reached
+        if checkpoint_path is not None:
+            return Checkpoint(checkpoint_path, capacity=buffer_size)
+        return SeenSet(capacity=buffer_size, path=seen_path)
+
+    def _resume_replies(self, r, checkpoint):
+        # Replies that were queued but not posted yet when the bot stopped
+        for entry in list(checkpoint.pending.values()):
+            item = r.get_info(thing_id=entry['fullname'])
+            if item is None:
+                # Deleted in the meantime
+                checkpoint.add(entry['id'])
+            else:
+                self.replies.put(entry['kind'], item, entry['cards'], entry['response'])
+        self.log('Resumed from checkpoint: {} log entries replayed, {} items done, {} replies pending.'.format(
+            checkpoint.replayed, len(checkpoint), len(checkpoint.pending)))
+
+    @staticmethod
+    def _fetchers(r, subreddit, batch_limit):
+        def timed(stage, listing):
+            def fetch(params, limit):
+                # praw keeps following 'after' until it has limit items, which would walk back past the cursor on a
+                # short page. With limit=0 it makes a single request, and the page size goes in the params instead.
+                with STAGE_SECONDS.time(stage=stage):
+                    return list(listing(limit=0, params=dict(params, limit=limit)))
+            return fetch
+
+        return (StreamFetcher(timed('fetch_submissions', subreddit.get_new), page_size=batch_limit),
+                StreamFetcher(timed('fetch_comments', lambda **kwargs: r.get_comments(subreddit, **kwargs)),
+                              page_size=TESLCardBot.COMMENTS_PAGE_SIZE))
+
+    def _poll(self, r, subreddit, batch_limit, already_done):
+        import praw
+
+        def is_new(item):
+            return item.id not in already_done and item.id not in self.replies
+
+        submissions, comments = TESLCardBot._fetchers(r, subreddit, batch_limit)
+        if isinstance(already_done, Checkpoint):
+            already_done.track('submissions', submissions)
+            already_done.track('comments', comments)
         while True:
+            found = 0
             try:
-                new_submissions = [s for s in subreddit.get_new(limit=batch_limit) if s.id not in already_done]
-                new_comments = [c for c in r.get_comments(subreddit) if c.id not in already_done]
+                # Items are processed as they're fetched, a burst can span several pages.
+                # Items with a reply queued are only marked as done once the reply is up and the item is saved,
+                # the bot also saves them on Reddit to prevent double-posting.
+                for s in submissions.poll():
+                    if is_new(s):
+                        found += 1
+                        if not self._process_submission(s):
+                            already_done.add(s.id)
+                for c in comments.poll():
+                    if is_new(c):
+                        found += 1
+                        if not self._process_comment(c):
+                            already_done.add(c.id)
             except praw.errors.HTTPException as e:
+                ERRORS.inc(stage='fetch')
                 self.log('Reddit seems to be down! Aborting.')
                 self.log(e)
                 return
 
-            for s in new_submissions:
-                self._process_submission(s)
-                # The bot will also save submissions it replies to to prevent double-posting.
-                already_done.append(s.id)
-            for c in new_comments:
-                self._process_comment(c)
-                # The bot will also save comments it replies to to prevent double-posting.
-                already_done.append(c.id)
+            if found > 0:
+                already_done.save()
 
-            # If we're using too much memory, remove the bottom elements
-            if len(already_done) >= buffer_size:
-                already_done = already_done[batch_limit:]
+    def start_async(self, batch_limit=10, buffer_size=1000, seen_path=None, checkpoint_path=None):
+        from teslcardbot.engine import AsyncEngine
+        engine = AsyncEngine(self, batch_limit=batch_limit, buffer_size=buffer_size, seen_path=seen_path,
+                             checkpoint_path=checkpoint_path)
+        engine.start()
 
-    def __init__(self, author='Anonymous', target_sub='all'):
+    def __init__(self, author='Anonymous', target_sub='all', lookup_workers=4, lookup_timeout=10):
         self.author = author
         self.target_sub = target_sub
+        self.lookup_workers = lookup_workers
+        # How many seconds a single response may spend looking up cards
+        self.lookup_timeout = lookup_timeout
+        self.replies = None
+        self._executor = None
+
+
+CACHES.append(('response', lambda: TESLCardBot.RESPONSE_CACHE))
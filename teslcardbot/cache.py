@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import threading
+import tempfile
+import atexit
+import json
+import time
+import os
+
+
+class LRUCache:
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None, expires=None):
+        ttl = self.ttl if ttl is None else ttl
+        if expires is None and ttl is not None:
+            expires = time.time() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            # Evict the least recently used entries first
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def items(self):
+        with self._lock:
+            return [(k, v) for k, v in self._data.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ImageCache:
+    # Images rarely disappear, while a missing image might be uploaded at any time
+    DEFAULT_TTL = 60 * 60 * 24
+    DEFAULT_NEGATIVE_TTL = 60 * 60
+
+    def __init__(self, path=None, max_size=2048, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 flush_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Seconds between writes to disk, everything checked in between is written at once
+        self.flush_interval = flush_interval
+        self._cache = LRUCache(max_size=max_size)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flushed_at = time.time()
+        if path is not None:
+            self._load()
+            # Whatever hasn't been written yet still makes it to disk when the bot shuts down
+            atexit.register(self.flush)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    def get(self, url):
+        # Returns True/False for known urls, None if the url has to be checked
+        return self._cache.get(url)
+
+    def set(self, url, exists):
+        self._cache.set(url, exists, ttl=self.ttl if exists else self.negative_ttl)
+        if self.path is not None:
+            self._dirty = True
+            if time.time() - self._flushed_at >= self.flush_interval:
+                self.flush()
+
+    def exists(self, url, check):
+        exists = self.get(url)
+        if exists is None:
+            exists = check(url)
+            # The check couldn't give an answer, try again next time
+            if exists is not None:
+                self.set(url, exists)
+        return exists
+
+    def stats(self):
+        return self._cache.stats()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+        now = time.time()
+        known = dict(self._cache.items())
+        for url, (exists, expires) in entries.items():
+            # Whichever answer is newer wins, it's the one that expires last
+            if expires > now and (url not in known or known[url][1] is None or known[url][1] < expires):
+                self._cache.set(url, exists, expires=expires)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._flushed_at = time.time()
+            try:
+                self._save()
+            except (IOError, OSError):
+                # It's only a cache, the checks are written with the next flush instead
+                return
+            self._dirty = False
+
+    def _save(self):
+        # Workers might share the file, so keep whatever the others checked in the meantime
+        self._load()
+        entries = {url: value for url, value in self._cache.items()}
+        # Write to a temporary file of our own first, so that neither a crash nor another worker saving at the same
+        # time can leave a truncated cache behind
+        fd, tmp = tempfile.mkstemp(prefix='{}.'.format(os.path.basename(self.path)), suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except (IOError, OSError):
+            os.unlink(tmp)
+            raise
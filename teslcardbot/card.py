@@ -0,0 +1,403 @@
+from teslcardbot.cache import ImageCache, LRUCache
+from teslcardbot.store import CardStore, CardRecord, load_compiled, compiled_filename, image_manifest_filename, \
+    code_digest
+from teslcardbot.metrics import REGISTRY, STAGE_SECONDS, CARDS_LOOKED_UP, ERRORS
+from teslcardbot.query import QueryResult, QueryError
+from concurrent.futures import wait
+import threading
+import hashlib
+import json
+import re
+import os
+
+
+def remove_duplicates(seq):
+    seen = set()
+    seen_add = seen.add
+    return [x for x in seq if not (x in seen or seen_add(x))]
+
+
+class Card:
+    CARD_IMAGE_BASE_URL = 'http://www.legends-decks.com/img_cards/{}.png'
+    CARD_IMAGE_404_URL = 'http://imgur.com/1Lxy3DA'
+    JSON_DATA = []
+    KEYWORDS = ['Prophecy', 'Breakthrough', 'Guard', 'Regenerate', 'Charge', 'Ward', 'Shackle',
+                'Lethal', 'Pilfer', 'Last Gasp', 'Summon', 'Drain']
+    PARTIAL_MATCH_END_LENGTH = 20
+    # How similar a misspelled name has to be to a card's for the card to be used anyway, from 0 to 1
+    FUZZY_MATCH_THRESHOLD = 0.6
+    ROW_TEMPLATE = '[📷]({url}) {name} ' \
+                   '| {type} | {stats} | {keywords} | {attrs} | {unique}{rarity} | {text}'
+    # Puts the text in the tooltip of the camera emoji instead of its own column
+    TOOLTIP_ROW_TEMPLATE = '[📷]({url} "{text}") {name} ' \
+                           '| {type} | {stats} | {keywords} | {attrs} | {unique}{rarity}'
+    RENDER_CACHE = LRUCache(max_size=512)
+    ESCAPE_REGEX = re.compile(r'[\s_\-"\',;{\}]')
+    ITEM_STATS_REGEX = re.compile(r'\+(\d)/\+(\d)')
+    KEYWORD_REGEX = re.compile(r'((?<!Gasp:\s)\w+(?:\sGasp)?)', re.I)
+    # Lowercase keyword to how it's spelled in KEYWORDS
+    KEYWORD_LOOKUP = {k.lower(): k for k in KEYWORDS}
+    # Parsed from JSON_DATA, in the same order
+    STORE = CardStore([], source=JSON_DATA)
+    _DATA_LOCK = threading.Lock()
+    IMAGE_CACHE = ImageCache()
+    # Image url to whether it exists, read from the manifest next to cards.json so that those are never checked live
+    IMAGE_MANIFEST = {}
+    # Created the first time an image is checked
+    HTTP_CLIENT = None
+    # SHA-1 of the cards.json and images.json that were loaded, so that a watcher knows what it's comparing against
+    DATA_DIGEST = None
+    MANIFEST_DIGEST = None
+
+    @staticmethod
+    def _data_filename(path='data/cards.json'):
+        dir = os.path.dirname(__file__)
+        return os.path.join(dir, path)
+
+    @staticmethod
+    def preload_card_data(path='data/cards.json'):
+        filename = Card._data_filename(path)
+        with open(filename, 'rb') as f:
+            raw = f.read()
+
+        # Use the compiled database if it's there and up to date, it's a lot faster than parsing the JSON again
+        store = load_compiled(raw, compiled_filename(filename), Card._code_digest())
+        if store is None:
+            data = json.loads(raw.decode('utf-8'))
+            store = Card._build_store(data)
+        Card._swap_data(store.source, store)
+        Card.DATA_DIGEST = hashlib.sha1(raw).hexdigest()
+        Card.load_image_manifest(image_manifest_filename(filename))
+
+    @staticmethod
+    def _code_digest():
+        # Image urls, keywords and stats all come from here, a database compiled by other code is stale too
+        return code_digest([__name__], [Card.CARD_IMAGE_BASE_URL, Card.KEYWORDS, Card.KEYWORD_REGEX.pattern])
+
+    @staticmethod
+    def load_image_manifest(filename):
+        digest = None
+        try:
+            with open(filename, 'rb') as f:
+                raw = f.read()
+            digest = hashlib.sha1(raw).hexdigest()
+            manifest = json.loads(raw.decode('utf-8'))
+        except (IOError, ValueError):
+            manifest = None
+
+        urls = {}
+        # A manifest made for another image host doesn't say anything about this one
+        if manifest is not None and manifest.get('base_url') == Card.CARD_IMAGE_BASE_URL:
+            urls.update((Card.CARD_IMAGE_BASE_URL.format(name), True) for name in manifest.get('images', {}))
+            urls.update((Card.CARD_IMAGE_BASE_URL.format(name), False) for name in manifest.get('missing', []))
+        Card.IMAGE_MANIFEST = urls
+        Card.MANIFEST_DIGEST = digest
+
+    @staticmethod
+    def _build_store(data):
+        return CardStore([Card._parse_record(d) for d in data], source=data)
+
+    @staticmethod
+    def _swap_data(data, store):
+        # Lookups only ever read Card.STORE once, so they see either the old or the new cards, never a mix
+        with Card._DATA_LOCK:
+            Card.STORE = store
+            Card.JSON_DATA = data
+        # Rows rendered from the old data might not be right anymore
+        Card.RENDER_CACHE.clear()
+
+    @staticmethod
+    def _get_store():
+        store = Card.STORE
+        # JSON_DATA might have been replaced without going through preload_card_data
+        if store.source is not Card.JSON_DATA:
+            with Card._DATA_LOCK:
+                if Card.STORE.source is not Card.JSON_DATA:
+                    Card.STORE = Card._build_store(Card.JSON_DATA)
+                store = Card.STORE
+        return store
+
+    @staticmethod
+    def _parse_record(data):
+        escaped_name = Card._escape_name(data['name'])
+        type = data.get('type', '')
+        attr_1 = data.get('attribute_1', '')
+        attr_2 = data.get('attribute_2', '')
+        text = data.get('text', '')
+        stats, keywords = Card._analyze_text(text)
+        power = ''
+        health = ''
+        if type == 'creature':
+            power = int(data['attack'])
+            health = int(data['health'])
+        elif type == 'item':
+            # Stats granted by items are extracted from their text, if they're there
+            if stats is not None:
+                power, health = stats
+            else:
+                power = int(data['attack'])
+                health = int(data['health'])
+
+        return CardRecord(name=data['name'],
+                          escaped_name=escaped_name,
+                          img_url=Card.CARD_IMAGE_BASE_URL.format(escaped_name),
+                          type=type,
+                          attributes=(attr_1.title(), attr_2.title()) if len(attr_2) > 0 else (attr_1.title(),),
+                          rarity=data.get('rarity', ''),
+                          unique=data.get('isunique') in (True, 'true'),
+                          cost=int(data['cost']) if 'cost' in data else 0,
+                          power=power,
+                          health=health,
+                          race=data.get('race', ''),
+                          text=text,
+                          keywords=tuple(keywords))
+
+    @staticmethod
+    def _escape_name(card):
+        return Card.ESCAPE_REGEX.sub('', card).lower()
+
+    @staticmethod
+    def _img_exists(url):
+        # If the image host is down the card gets the placeholder image
+        return Card.IMAGE_CACHE.exists(url, Card._check_img) is True
+
+    @staticmethod
+    def _check_img(url):
+        if Card.HTTP_CLIENT is None:
+            # Imported here so that looking cards up doesn't pull in requests until it's needed
+            from teslcardbot.httpclient import HttpClient
+            Card.HTTP_CLIENT = HttpClient()
+        with STAGE_SECONDS.time(stage='image_check'):
+            return Card.HTTP_CLIENT.image_exists(url)
+
+    @staticmethod
+    def _analyze_text(text):
+        # Returns the stats an item grants, if they're in its text, and the card's keywords
+        stats = Card.ITEM_STATS_REGEX.search(text)
+        if stats is not None:
+            # If the card is an item, remove the +x/+y from its text.
+            text = Card.ITEM_STATS_REGEX.sub('', text)
+            stats = tuple(map(int, stats.groups()))
+
+        # Keywords are extracted until a non-keyword word is found
+        keywords = []
+        for match in Card.KEYWORD_REGEX.finditer(text):
+            keyword = Card.KEYWORD_LOOKUP.get(match.group(1).lower())
+            if keyword is None:
+                break
+            keywords.append(keyword)
+        return stats, remove_duplicates(keywords)
+
+    @staticmethod
+    def _extract_keywords(text):
+        return Card._analyze_text(text)[1]
+
+    @staticmethod
+    def _fetch_index_partial(name, store):
+        # Narrow the query down one character at a time until at most one card is left
+        count, first = 0, None
+        for i in range(min(len(name), Card.PARTIAL_MATCH_END_LENGTH) + 1):
+            count, first = store.find_prefix(Card._escape_name(name[:i]))
+            if count <= 1:
+                break
+
+        if count == 0:
+            return None
+
+        if store[first].escaped_name[:len(name)] == Card._escape_name(name):
+            return first
+        return None
+
+    @staticmethod
+    def _fetch_record_partial(name):
+        store = Card._get_store()
+        i = Card._fetch_index_partial(name, store)
+        return None if i is None else store[i]
+
+    @staticmethod
+    def _fetch_record_fuzzy(name):
+        store = Card._get_store()
+        i = store.find_fuzzy(Card._escape_name(name), Card.FUZZY_MATCH_THRESHOLD)
+        return None if i is None else store[i]
+
+    @staticmethod
+    def _fetch_data_partial(name):
+        store = Card._get_store()
+        i = Card._fetch_index_partial(name, store)
+        return None if i is None else store.source[i]
+
+    @staticmethod
+    def get_info(name, check_image=True):
+        return Card.get_info_many([name], check_image=check_image)[0]
+
+    @staticmethod
+    def get_info_many(names, check_image=True, executor=None, timeout=None):
+        # Names that escape to the same thing are only looked up once, and every image is only checked once
+        escaped = [Card._escape_name(name) for name in names]
+        unique = remove_duplicates(escaped)
+
+        # If JSON_DATA hasn't been populated yet, try to do it now or fail miserably.
+        if len(Card.JSON_DATA) <= 0 and any(name != 'teslcardbot' for name in unique):
+            Card.preload_card_data()
+            assert (len(Card.JSON_DATA) > 0)
+
+        records = {name: Card._find_record(name) for name in unique if name != 'teslcardbot'}
+        img_urls = {}
+        if check_image:
+            img_urls = Card._check_imgs(remove_duplicates(r.img_url for r in records.values() if r is not None),
+                                        executor, timeout)
+
+        cards = {}
+        for name in unique:
+            if name == 'teslcardbot':  # I wonder...
+                cards[name] = Card('TESLCardBot', 'https://imgs.xkcd.com/comics/tabletop_roleplaying.png',
+                                   type='Bot',
+                                   attribute_1='Python',
+                                   attribute_2='JSON',
+                                   rarity='Legendary',
+                                   text='If your have more health than your opponent, win the game.',
+                                   cost='∞', power='∞', health='∞')
+            elif records[name] is None:
+                cards[name] = None
+            else:
+                record = records[name]
+                cards[name] = Card._from_record(record, img_urls.get(record.img_url, record.img_url))
+        return [cards[name] for name in escaped]
+
+    @staticmethod
+    def search(query, limit=10, check_image=True, executor=None, timeout=None):
+        # Finds the cards matching a query like "3-cost willpower creatures with guard", see QueryIndex
+        if len(Card.JSON_DATA) <= 0:
+            Card.preload_card_data()
+            assert (len(Card.JSON_DATA) > 0)
+
+        try:
+            records, total = Card._get_store().search(query, limit)
+        except QueryError as e:
+            CARDS_LOOKED_UP.inc(result='bad_query')
+            return QueryResult(query, [], 0, str(e))
+        CARDS_LOOKED_UP.inc(result='query' if total > 0 else 'not_found')
+
+        img_urls = {}
+        if check_image:
+            img_urls = Card._check_imgs(remove_duplicates(r.img_url for r in records), executor, timeout)
+        cards = [Card._from_record(r, img_urls.get(r.img_url, r.img_url)) for r in records]
+        return QueryResult(query, cards, total, None)
+
+    @staticmethod
+    def _find_record(name):
+        record = Card._fetch_record_partial(name)
+        result = 'matched'
+        # Maybe it's just a typo?
+        if record is None:
+            record = Card._fetch_record_fuzzy(name)
+            result = 'fuzzy'
+
+        CARDS_LOOKED_UP.inc(result=result if record is not None else 'not_found')
+        return record
+
+    @staticmethod
+    def _check_imgs(urls, executor=None, timeout=None):
+        # Maps every url to the one that should be used instead, images that don't exist get the placeholder
+        manifest = Card.IMAGE_MANIFEST
+        img_urls = {url: url if manifest[url] else Card.CARD_IMAGE_404_URL for url in urls if url in manifest}
+        # Only cards newer than the manifest, or without one at all, are checked over the network
+        urls = [url for url in urls if url not in manifest]
+        if executor is None or len(urls) == 0:
+            img_urls.update((url, url if Card._img_exists(url) else Card.CARD_IMAGE_404_URL) for url in urls)
+            return img_urls
+
+        futures = [executor.submit(Card._img_exists, url) for url in urls]
+        done, not_done = wait(futures, timeout=timeout)
+        for url, future in zip(urls, futures):
+            if future in done:
+                img_urls[url] = url if future.result() else Card.CARD_IMAGE_404_URL
+            else:
+                # Don't let a slow image host hold up the whole reply, the image just goes unchecked
+                future.cancel()
+                ERRORS.inc(stage='image_check_timeout')
+        return img_urls
+
+    @staticmethod
+    def _from_record(record, img_url):
+        # Everything has already been parsed, so skip __init__
+        card = Card.__new__(Card)
+        card.name = record.name
+        card.img_url = img_url
+        card.type = record.type
+        card.attributes = list(record.attributes)
+        card.rarity = record.rarity
+        card.unique = record.unique
+        card.cost = record.cost
+        card.power = record.power
+        card.health = record.health
+        card.text = record.text
+        card.keywords = list(record.keywords)
+        return card
+
+    def __init__(self, name, img_url, type='Creature', attribute_1='neutral',
+                 attribute_2='', text='', rarity='Common', unique=False, cost=0, power=0, health=0):
+        self.name = name
+        self.img_url = img_url
+        self.type = type
+        self.attributes = [attribute_1.title(), attribute_2.title()] if len(attribute_2) > 0 else [attribute_1.title()]
+        self.rarity = rarity
+        self.unique = unique
+        self.cost = cost
+        self.power = power
+        self.health = health
+        self.text = text
+        self.keywords = Card._extract_keywords(text)
+
+    def __str__(self):
+        key = self._render_key()
+        row = Card.RENDER_CACHE.get(key)
+        if row is None:
+            row = self._render()
+            Card.RENDER_CACHE.set(key, row)
+        return row
+
+    def _render_key(self):
+        # Everything the rendered row depends on
+        return (self.ROW_TEMPLATE, self.name, self.img_url, self.type, tuple(self.attributes), self.rarity,
+                self.unique, self.cost, self.power, self.health, self.text, tuple(self.keywords))
+
+    def _render(self):
+        def _format_stats(t):
+            if self.type == 'creature':
+                return t.format(self.cost, self.power, self.health)
+            elif self.type == 'item':
+                return t.format(self.cost, '+{}'.format(self.power), '+{}'.format(self.health))
+            else:
+                return t.format(self.cost, '?', '?')
+
+        return self.ROW_TEMPLATE.format(
+            attrs='/'.join(map(str, self.attributes)),
+            unique='' if not self.unique else 'Unique ',
+            rarity=self.rarity.title(),
+            name=self.name,
+            url=self.img_url,
+            type=self.type.title(),
+            mana=self.cost,
+            stats=_format_stats('{} - {}/{}'),
+            keywords=', '.join(map(str, self.keywords)) + '' if len(self.keywords) > 0 else 'None',
+            text=self.text if len(self.text) > 0 else 'This card\'s name isn\'t in the database. Possible typo?'
+        )
+
+
+# Caches reported in the cache metrics, other modules can add their own
+CACHES = [('image', lambda: Card.IMAGE_CACHE), ('render', lambda: Card.RENDER_CACHE)]
+
+
+def _cache_stats(stat):
+    def f():
+        caches = [(name, get().stats()) for name, get in CACHES]
+        if stat == 'hit_ratio':
+            return [({'cache': name}, c['hits'] / max(1, c['hits'] + c['misses'])) for name, c in caches]
+        return [({'cache': name}, c[stat]) for name, c in caches]
+    return f
+
+
+for stat in ['hits', 'misses', 'size', 'hit_ratio']:
+    REGISTRY.gauge('teslcardbot_cache_{}'.format(stat), 'Cache {}.'.format(stat.replace('_', ' ')), ['cache'],
+                   function=_cache_stats(stat))
@@ -0,0 +1,123 @@
+from teslcardbot.seen import SeenSet
+from collections import OrderedDict
+import threading
+import json
+import os
+
+
+class Checkpoint:
+    # Works like a SeenSet, but every change is appended to a log so that a restarted bot picks up where it left off
+    def __init__(self, path, capacity=1000, compact_every=1000):
+        self.path = path
+        self.compact_every = compact_every
+        self.seen = SeenSet(capacity=capacity)
+        # Source name to (fullname, created_utc) of the newest item fetched from it
+        self.cursors = {}
+        # Item id to the reply that was queued for it but not posted yet
+        self.pending = OrderedDict()
+        # How many log entries were read back when the checkpoint was loaded
+        self.replayed = 0
+        self._fetchers = {}
+        self._appended = 0
+        self._file = None
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except IOError:
+            lines = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line might have been cut short by a crash
+                continue
+            self._apply(entry)
+            self.replayed += 1
+        # Start over from a clean log, without the entries that don't matter anymore
+        self.compact()
+
+    def _apply(self, entry):
+        op = entry.get('op')
+        if op == 'done':
+            self.seen.add(entry['id'])
+            self.pending.pop(entry['id'], None)
+        elif op == 'cursor':
+            self.cursors[entry['source']] = (entry['cursor'], entry['high_water'])
+        elif op == 'pending':
+            self.pending[entry['id']] = entry
+
+    def _append(self, entry):
+        with self._lock:
+            self._apply(entry)
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            self._appended += 1
+            if self._appended >= self.compact_every:
+                self.compact()
+
+    def compact(self):
+        # Rewrites the log with one entry per thing that still matters
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            # Write to a temporary file first so a crash can't leave a truncated log behind
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                for id in self.seen:
+                    f.write(json.dumps({'op': 'done', 'id': id}) + '\n')
+                for source, (cursor, high_water) in self.cursors.items():
+                    f.write(json.dumps({'op': 'cursor', 'source': source, 'cursor': cursor,
+                                        'high_water': high_water}) + '\n')
+                for entry in self.pending.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp, self.path)
+            self._file = open(self.path, 'a')
+            self._appended = 0
+
+    def add(self, id):
+        if id in self.seen:
+            return
+        self._append({'op': 'done', 'id': id})
+
+    def add_pending(self, kind, item, cards, response):
+        self._append({'op': 'pending', 'kind': kind, 'id': item.id, 'fullname': item.fullname, 'cards': cards,
+                      'response': response, 'created_utc': getattr(item, 'created_utc', None)})
+
+    def track(self, source, fetcher, position=None):
+        # Resumes the fetcher from where it was, its progress is recorded every time the checkpoint is saved.
+        # position() returns the (cursor, high_water) to record when that's not simply where the fetcher is.
+        self._fetchers[source] = position if position is not None else lambda: (fetcher.cursor, fetcher.high_water)
+        if source in self.cursors:
+            fetcher.cursor, fetcher.high_water = self.cursors[source]
+
+    def save(self):
+        for source, position in list(self._fetchers.items()):
+            cursor, high_water = position()
+            if cursor is not None and self.cursors.get(source) != (cursor, high_water):
+                self._append({'op': 'cursor', 'source': source, 'cursor': cursor, 'high_water': high_water})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @property
+    def evicted(self):
+        return self.seen.evicted
+
+    def stats(self):
+        return self.seen.stats()
+
+    def __contains__(self, id):
+        return id in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+    def __iter__(self):
+        return iter(self.seen)
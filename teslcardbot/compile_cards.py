@@ -0,0 +1,22 @@
+from teslcardbot.store import compiled_filename, save_compiled
+from teslcardbot.card import Card
+import argparse
+import json
+
+
+def compile_cards(filename, output=None):
+    output = compiled_filename(filename) if output is None else output
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    save_compiled(Card._build_store(json.loads(raw.decode('utf-8'))), raw, output, Card._code_digest())
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compiles cards.json into a database that loads faster.')
+    parser.add_argument('-i', '--input', default=Card._data_filename(), help='The card data to compile.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Where to write the database, next to the input by default.')
+    args = parser.parse_args()
+
+    print('Compiled {} into {}.'.format(args.input, compile_cards(args.input, args.output)))
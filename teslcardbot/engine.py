@@ -0,0 +1,192 @@
+from teslcardbot.card import Card
+from teslcardbot.metrics import REGISTRY, ERRORS, register_seen_metrics
+from teslcardbot.replies import ReplyQueue
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import asyncio
+import praw
+
+
+class AdaptiveInterval:
+    def __init__(self, minimum=2, maximum=60, factor=2):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.current = minimum
+
+    def update(self, busy):
+        # Poll again quickly while there's activity, back off while the sub is idle
+        if busy:
+            self.current = self.minimum
+        else:
+            self.current = min(self.current * self.factor, self.maximum)
+        return self.current
+
+
+class AsyncEngine:
+    def __init__(self, bot, batch_limit=10, buffer_size=1000, seen_path=None, lookup_workers=2, queue_size=100,
+                 min_interval=2, max_interval=60, checkpoint_path=None):
+        self.bot = bot
+        self.batch_limit = batch_limit
+        self.already_done = bot._progress(buffer_size, seen_path, checkpoint_path)
+        self.checkpoint_path = checkpoint_path
+        register_seen_metrics(self.already_done)
+        self.lookup_workers = lookup_workers
+        self.queue_size = queue_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lookups = None
+        self.replies = None
+        # praw isn't thread-safe, so every call to Reddit goes through the same thread
+        self._reddit_executor = ThreadPoolExecutor(max_workers=1)
+        self._in_flight = set()
+        # For every kind, the ids of the items that are still being handled, oldest first, each with the fetcher
+        # position it has to resume from for the item to be fetched again
+        self._holds = {}
+        # For every kind, where the fetcher was after the last poll whose items are all held. The fetcher itself
+        # moves on in the Reddit thread while the other kind's poller might be saving the checkpoint.
+        self._positions = {}
+        self._stopping = None
+        self._loop = None
+
+    def _reddit(self, f, *args):
+        return self._loop.run_in_executor(self._reddit_executor, f, *args)
+
+    def _done(self, item):
+        self._in_flight.discard(item.id)
+        for holds in self._holds.values():
+            holds.pop(item.id, None)
+        self.already_done.add(item.id)
+
+    def _position(self, kind, fetcher):
+        # The checkpoint never gets ahead of an item that's still being handled, or a crash would skip it for good
+        holds = self._holds.get(kind)
+        if holds:
+            return next(iter(holds.values()))
+        return self._positions.get(kind, (fetcher.cursor, fetcher.high_water))
+
+    async def _poll(self, kind, fetcher):
+        def fetch():
+            # An item is yielded before the fetcher moves past it, so this is where it would be fetched again from
+            items = [(item, (fetcher.cursor, fetcher.high_water)) for item in fetcher.poll()]
+            return items, (fetcher.cursor, fetcher.high_water)
+
+        interval = AdaptiveInterval(self.min_interval, self.max_interval)
+        holds = self._holds.setdefault(kind, OrderedDict())
+        self._positions[kind] = (fetcher.cursor, fetcher.high_water)
+        while not self._stopping.is_set():
+            try:
+                # Every page goes through the Reddit thread, the fetcher times them
+                items, position = await self._reddit(fetch)
+            except praw.errors.HTTPException as e:
+                ERRORS.inc(stage='fetch')
+                self.bot.log('Reddit seems to be down! Aborting.')
+                self.bot.log(e)
+                return
+
+            new_items = [(item, position) for item, position in items
+                         if item.id not in self.already_done and item.id not in self._in_flight]
+            # Held before anything can be saved, putting items on the queue might wait for a while
+            for item, held in new_items:
+                self._in_flight.add(item.id)
+                holds[item.id] = held
+            self._positions[kind] = position
+            for item, _ in new_items:
+                await self.lookups.put((kind, item))
+            self.already_done.save()
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), interval.update(len(new_items) > 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _lookup(self):
+        while True:
+            kind, item = await self.lookups.get()
+            try:
+                self.bot._observe_item(kind, item)
+                if kind == 'submission':
+                    cards = self.bot._submission_mentions(item)
+                else:
+                    cards = self.bot._comment_mentions(item)
+
+                if len(cards) > 0:
+                    response = await self._loop.run_in_executor(None, self.bot.build_response, cards)
+                    if kind == 'submission':
+                        self.bot.log('Commenting in {} about the following cards: {}'.format(item.title, cards))
+                    else:
+                        self.bot.log('Replying to {} about the following cards: {}'.format(item.id, cards))
+                    # Only marked as done once the reply is up and the item is saved
+                    self.replies.put(kind, item, cards, response)
+                else:
+                    self._done(item)
+            finally:
+                self.lookups.task_done()
+
+    async def _drain(self, pollers):
+        await asyncio.wait(pollers)
+        await self.lookups.join()
+        await self._loop.run_in_executor(None, self.replies.join)
+
+    async def run(self):
+        self._loop = asyncio.get_event_loop()
+        self._stopping = asyncio.Event()
+        self.lookups = asyncio.Queue(maxsize=self.queue_size)
+        # Posted from the reply queue's own thread, but still through the thread that owns praw
+        self.replies = ReplyQueue(self.bot, on_done=lambda item: self._loop.call_soon_threadsafe(self._done, item),
+                                  call=lambda f, *args: self._reddit_executor.submit(f, *args).result(),
+                                  on_queued=self.already_done.add_pending if self.checkpoint_path is not None else None)
+        REGISTRY.gauge('teslcardbot_queue_depth', 'Items waiting in each queue of the async engine.', ['queue'],
+                       function=lambda: [({'queue': 'lookups'}, self.lookups.qsize()),
+                                         ({'queue': 'replies'}, len(self.replies))])
+
+        try:
+            r = await self._reddit(self.bot._get_praw_instance)
+        except praw.errors.HTTPException as e:
+            self.bot.log('Reddit seems to be down! Aborting.')
+            self.bot.log(e)
+            return
+        subreddit = await self._reddit(r.get_subreddit, self.bot.target_sub)
+
+        submissions, comments = self.bot._fetchers(r, subreddit, self.batch_limit)
+        if self.checkpoint_path is not None:
+            self.already_done.track('submissions', submissions,
+                                    position=lambda: self._position('submission', submissions))
+            self.already_done.track('comments', comments, position=lambda: self._position('comment', comments))
+            # The bot's replies go to the same queue as the engine's
+            self.bot.replies = self.replies
+            await self._reddit(self.bot._resume_replies, r, self.already_done)
+            self._in_flight.update(self.already_done.pending)
+        pollers = [asyncio.ensure_future(self._poll('submission', submissions)),
+                   asyncio.ensure_future(self._poll('comment', comments))]
+        workers = [asyncio.ensure_future(self._lookup()) for _ in range(self.lookup_workers)]
+        self.replies.start()
+
+        # Run until polling stops or a worker crashes, then finish whatever is already queued
+        done, _ = await asyncio.wait(pollers + workers, return_when=asyncio.FIRST_COMPLETED)
+        self._stopping.set()
+        tasks = pollers + workers
+        if not any(w in done for w in workers):
+            tasks.append(asyncio.ensure_future(self._drain(pollers)))
+            done, _ = await asyncio.wait(workers + tasks[-1:], return_when=asyncio.FIRST_COMPLETED)
+
+        for task in tasks:
+            task.cancel()
+        self.replies.stop()
+        self.already_done.save()
+        for task in done:
+            task.result()
+
+    def stop(self):
+        # Can be called from any thread
+        self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def start(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            self._reddit_executor.shutdown(wait=False)
+            loop.close()
+            Card.IMAGE_CACHE.flush()
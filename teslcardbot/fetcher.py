@@ -0,0 +1,54 @@
+class StreamFetcher:
+    def __init__(self, fetch, page_size=100, resync_every=10):
+        # fetch(params, limit) returns a single page of a listing, newest first like Reddit does
+        self.fetch = fetch
+        self.page_size = page_size
+        # Idle polls before checking that the cursor still works, Reddit returns nothing after a deleted item
+        self.resync_every = resync_every
+        # Fullname and creation time of the newest item handed out so far
+        self.cursor = None
+        self.high_water = None
+        self._idle_polls = 0
+
+    def _advance(self, item):
+        created = getattr(item, 'created_utc', None)
+        self.cursor = item.fullname
+        if created is not None and (self.high_water is None or created > self.high_water):
+            self.high_water = created
+
+    def poll(self):
+        # Yields the items newer than the cursor, oldest first. The cursor only moves past an item once the next one
+        # is asked for, so an item that blew up while being processed is fetched again next time.
+        if self.cursor is None:
+            for item in self._resync():
+                yield item
+            return
+
+        found = 0
+        while True:
+            page = list(self.fetch({'before': self.cursor}, self.page_size))
+            for item in reversed(page):
+                yield item
+                self._advance(item)
+            found += len(page)
+            # A full page means there might be more, so keep going from the newest item
+            if len(page) < self.page_size:
+                break
+
+        if found > 0:
+            self._idle_polls = 0
+            return
+        self._idle_polls += 1
+        if self._idle_polls >= self.resync_every:
+            self._idle_polls = 0
+            for item in self._resync():
+                yield item
+
+    def _resync(self):
+        # Starts over from the newest page, anything older than the high-water mark was already handed out
+        page = list(self.fetch({}, self.page_size))
+        for item in reversed(page):
+            created = getattr(item, 'created_utc', None)
+            if self.high_water is None or created is None or created > self.high_water:
+                yield item
+            self._advance(item)
@@ -0,0 +1,38 @@
+class TrigramIndex:
+    def __init__(self, names):
+        self.names = list(names)
+        self.sizes = []
+        # Maps every trigram to the ids of the names it appears in
+        self.postings = {}
+        for i, name in enumerate(self.names):
+            trigrams = TrigramIndex.trigrams(name)
+            self.sizes.append(len(trigrams))
+            for t in trigrams:
+                self.postings.setdefault(t, []).append(i)
+
+    @staticmethod
+    def trigrams(s):
+        # Padding lets short names and the start of a name weigh in as well
+        s = '  {} '.format(s)
+        return set(s[i:i + 3] for i in range(len(s) - 2))
+
+    def search(self, query, limit=5):
+        trigrams = TrigramIndex.trigrams(query)
+        shared = {}
+        for t in trigrams:
+            for i in self.postings.get(t, ()):
+                shared[i] = shared.get(i, 0) + 1
+
+        # Dice coefficient between the trigrams of the query and those of each candidate
+        scores = [(2.0 * n / (len(trigrams) + self.sizes[i]), i) for i, n in shared.items()]
+        scores.sort(key=lambda score: (-score[0], score[1]))
+        return scores[:limit]
+
+    def best(self, query, threshold=0.0):
+        scores = self.search(query, limit=1)
+        if len(scores) == 0 or scores[0][0] < threshold:
+            return None
+        return scores[0][1]
+
+    def __len__(self):
+        return len(self.names)
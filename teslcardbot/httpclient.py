@@ -0,0 +1,119 @@
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        # How many seconds to wait before letting a request through again
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # When the single trial request allowed while half-open was let through
+        self.probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CircuitBreaker.CLOSED
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return CircuitBreaker.HALF_OPEN
+        return CircuitBreaker.OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == CircuitBreaker.CLOSED:
+                return True
+            if state == CircuitBreaker.OPEN:
+                return False
+            # Only one trial request at a time while half-open, so a recovering host doesn't get the full load at once.
+            # A trial that never reported back is given up on after reset_timeout.
+            now = time.time()
+            if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+                return False
+            self.probe_started = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probe_started = None
+            # A failed trial request while half-open re-opens the circuit straight away
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.time()
+
+
+class HttpClient:
+    def __init__(self, connect_timeout=3.05, read_timeout=5, retries=2, backoff=0.5, pool_size=10,
+                 breaker=None, session=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._session = session
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Connections are pooled and kept alive across checks
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError('Too many failed requests, not contacting {} for now.'.format(url))
+            try:
+                res = self.session.request(method, url, **kwargs)
+                if res.status_code < 500:
+                    self.breaker.record_success()
+                    return res
+                res.close()
+                error = requests.HTTPError('{} returned {}'.format(url, res.status_code), response=res)
+            except requests.RequestException as e:
+                error = e
+
+            self.breaker.record_failure()
+            if attempt >= self.retries:
+                raise error
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def image_exists(self, url, content_type='image/png'):
+        # Returns None when the host can't be reached, so that the answer isn't cached
+        try:
+            res = self.request('HEAD', url, allow_redirects=True)
+            # Only the headers are needed, so don't download the whole image
+            if res.status_code == 405:
+                res = self.request('GET', url, stream=True)
+                res.close()
+        except (requests.RequestException, CircuitOpenError):
+            return None
+        return res.headers.get('content-type') == content_type
@@ -1,14 +1,58 @@
-from teslcardbot.bot import TESLCardBot
 import argparse
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='The Elder Scrolls: Legends bot for Reddit.')
     # No default value to prevent accidental mayhem
-    parser.add_argument('-s', '--target_sub', required=True, help='What subreddit will this instance monitor?')
+    parser.add_argument('-s', '--target_sub', required=True, nargs='+',
+                        help='What subreddits will this instance monitor?')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='How many worker processes should share the subreddits?')
+    parser.add_argument('--image_cache', default=None, help='Where should card image checks be cached between restarts?')
+    parser.add_argument('--engine', choices=['sync', 'async'], default='sync',
+                        help='Poll and reply from a single loop (sync) or from concurrent tasks (async).')
+    parser.add_argument('--seen_cache', default=None, help='Where should processed ids be kept between restarts?')
+    parser.add_argument('--checkpoint', default=None,
+                        help='Log progress and pending replies to this file and resume from it after a restart.')
+    parser.add_argument('--reload_interval', type=int, default=None,
+                        help='Check cards.json for changes every this many seconds and reload it.')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='Serve metrics in the Prometheus format on this local port. With several workers, '
+                             'worker i serves its own metrics on this port + i.')
+    parser.add_argument('--metrics_log_interval', type=int, default=None,
+                        help='Log all metrics every this many seconds.')
 
     args = parser.parse_args()
+    # Imported after parsing the arguments, so that --help and mistyped arguments don't wait on praw
+    from teslcardbot.bot import TESLCardBot, exit_on_sigterm
+    from teslcardbot.card import Card
+    from teslcardbot.cache import ImageCache
+    from teslcardbot.metrics import MetricsServer, MetricsLogger
+    if args.image_cache is not None:
+        Card.IMAGE_CACHE = ImageCache(path=args.image_cache)
 
-    print('TESLCardBot started! (/r/{})'.format(args.target_sub))
-    bot = TESLCardBot(author='G3Kappa', target_sub=args.target_sub)
-    bot.start(batch_limit=10, buffer_size=1000)
+    exit_on_sigterm()
+    print('TESLCardBot started! (/r/{})'.format('+'.join(args.target_sub)))
+    if len(args.target_sub) > 1 and args.workers > 1:
+        from teslcardbot.supervisor import Supervisor
+        # Workers start their own metrics and card watchers, the supervisor doesn't handle anything itself
+        supervisor = Supervisor(args.target_sub, workers=args.workers, author='G3Kappa',
+                                engine=args.engine, seen_path=args.seen_cache, checkpoint_path=args.checkpoint,
+                                metrics_port=args.metrics_port, metrics_log_interval=args.metrics_log_interval,
+                                reload_interval=args.reload_interval)
+        supervisor.start()
+    else:
+        if args.reload_interval is not None:
+            Card.preload_card_data()
+            from teslcardbot.reload import CardDataWatcher
+            CardDataWatcher(interval=args.reload_interval).start()
+        if args.metrics_port is not None:
+            MetricsServer(port=args.metrics_port).start()
+        if args.metrics_log_interval is not None:
+            MetricsLogger(interval=args.metrics_log_interval).start()
+        bot = TESLCardBot(author='G3Kappa', target_sub='+'.join(args.target_sub))
+        if args.engine == 'async':
+            bot.start_async(batch_limit=10, buffer_size=1000, seen_path=args.seen_cache,
+                            checkpoint_path=args.checkpoint)
+        else:
+            bot.start(batch_limit=10, buffer_size=1000, seen_path=args.seen_cache, checkpoint_path=args.checkpoint)
     print('TESLCardBot stopped running.')
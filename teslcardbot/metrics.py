@@ -0,0 +1,234 @@
+from contextlib import contextmanager
+import threading
+import json
+import time
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in pairs]
+    return '{{{}}}'.format(','.join(escaped))
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, key), value) for key, value in self._values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            return {','.join(key) if len(key) > 0 else '': value for key, value in self._values.items()}
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        Metric.__init__(self, name, help, labels)
+        # Evaluated every time the gauge is read, for values that live somewhere else
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            for labels, value in self.function():
+                self.set(value, **labels)
+        return Metric.samples(self)
+
+    def snapshot(self):
+        self.samples()
+        return Metric.snapshot(self)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, n in zip(self.buckets, counts):
+                    samples.append(('{}_bucket'.format(self.name),
+                                    _format_labels(self.labels, key, [('le', repr(float(bound)))]), n))
+                samples.append(('{}_bucket'.format(self.name), _format_labels(self.labels, key, [('le', '+Inf')]),
+                                count))
+                samples.append(('{}_sum'.format(self.name), _format_labels(self.labels, key), total))
+                samples.append(('{}_count'.format(self.name), _format_labels(self.labels, key), count))
+        return samples
+
+    def snapshot(self):
+        with self._lock:
+            return {','.join(key) if len(key) > 0 else '': {'count': count, 'sum': total}
+                    for key, (_, total, count) in self._values.items()}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # Registering the same name twice replaces the old metric
+            self.metrics = [m for m in self.metrics if m.name != metric.name] + [metric]
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in list(self.metrics):
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.TYPE))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in list(self.metrics)}
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram('teslcardbot_stage_seconds', 'Time spent in each stage of the bot.', ['stage'])
+POLL_LAG_SECONDS = REGISTRY.histogram('teslcardbot_poll_lag_seconds',
+                                      'Time between an item being posted and the bot processing it.', ['kind'],
+                                      buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+ITEMS_PROCESSED = REGISTRY.counter('teslcardbot_items_processed_total', 'Submissions and comments processed.', ['kind'])
+REPLIES_POSTED = REGISTRY.counter('teslcardbot_replies_posted_total', 'Replies posted.', ['kind'])
+ERRORS = REGISTRY.counter('teslcardbot_errors_total', 'Errors by stage.', ['stage'])
+CARDS_LOOKED_UP = REGISTRY.counter('teslcardbot_cards_looked_up_total', 'Card lookups by result.', ['result'])
+
+
+def register_seen_metrics(seen):
+    REGISTRY.gauge('teslcardbot_seen_ids', 'Ids currently remembered as processed.',
+                   function=lambda: [({}, len(seen))])
+    REGISTRY.gauge('teslcardbot_seen_evictions', 'Ids forgotten to stay within the buffer size.',
+                   function=lambda: [({}, seen.evicted)])
+
+
+def _metrics_handler(registry):
+    # http.server is slow to import and only needed when metrics are served
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return MetricsHandler
+
+
+class MetricsServer:
+    def __init__(self, port=9100, host='127.0.0.1', registry=REGISTRY):
+        from http.server import HTTPServer
+        self.server = HTTPServer((host, port), _metrics_handler(registry))
+        self.port = self.server.server_port
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsLogger:
+    def __init__(self, interval=60, registry=REGISTRY, log=print):
+        self.interval = interval
+        self.registry = registry
+        self.log = log
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.log_once()
+
+    def log_once(self):
+        # One JSON object per line, so that the lines are easy to grep and parse
+        self.log('TESLCardBot metrics # {}'.format(json.dumps(self.registry.snapshot(), sort_keys=True)))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
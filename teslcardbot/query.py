@@ -0,0 +1,148 @@
+from collections import namedtuple
+import re
+
+# What a query mention resolves to, error is set instead of cards when the query couldn't be understood
+QueryResult = namedtuple('QueryResult', ['query', 'cards', 'total', 'error'])
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _normalize(value):
+    return re.sub(r'[\s_\-\'"]', '', str(value).lower())
+
+
+class QueryIndex:
+    FIELDS = {'type': 'type', 'types': 'type',
+              'attribute': 'attribute', 'attributes': 'attribute', 'attr': 'attribute',
+              'rarity': 'rarity',
+              'cost': 'cost', 'mana': 'cost', 'magicka': 'cost',
+              'race': 'race',
+              'keyword': 'keyword', 'keywords': 'keyword'}
+    # Words that read naturally in a query but don't filter anything
+    STOPWORDS = {'all', 'and', 'with', 'card', 'cards', 'the', 'a', 'an', 'that', 'have', 'has', 'of'}
+    # 3, 3-cost, cost:3, 2-4 and 7+ all filter by cost
+    COST_REGEX = re.compile(r'^(?:(?:cost|mana|magicka):?)?(\d+)(?:(\+)|-(\d+))?(?:-?(?:cost|mana|magicka))?$')
+
+    def __init__(self, records):
+        # Every value maps to a bitset of the cards that have it, bit i being set for records[i]
+        self.index = {}
+        self.costs = {}
+        for i, record in enumerate(records):
+            bit = 1 << i
+            for field, value in QueryIndex._values(record):
+                key = (field, _normalize(value))
+                if len(key[1]) > 0:
+                    self.index[key] = self.index.get(key, 0) | bit
+            self.costs[record.cost] = self.costs.get(record.cost, 0) | bit
+
+        # Terms can be given without saying what they are, as long as it's obvious
+        self.vocabulary = {}
+        for (field, value), bits in sorted(self.index.items()):
+            if field != 'cost':
+                self.vocabulary.setdefault(value, bits)
+
+    @staticmethod
+    def _values(record):
+        yield 'type', record.type
+        for attribute in record.attributes:
+            yield 'attribute', attribute
+        yield 'rarity', record.rarity
+        yield 'race', record.race
+        for keyword in record.keywords:
+            yield 'keyword', keyword
+
+    def _cost(self, token):
+        match = QueryIndex.COST_REGEX.match(token)
+        if match is None:
+            return None
+        low, plus, high = match.groups()
+        low = int(low)
+        high = int(high) if high is not None else low
+        bits = 0
+        for cost, cost_bits in self.costs.items():
+            if isinstance(cost, int) and cost >= low and (plus is not None or cost <= high):
+                bits |= cost_bits
+        return bits
+
+    def _term(self, token):
+        if '|' in token:
+            bits = 0
+            for alternative in token.split('|'):
+                alternative_bits = self._term(alternative)
+                if alternative_bits is None:
+                    return None
+                bits |= alternative_bits
+            return bits
+
+        cost = self._cost(token)
+        if cost is not None:
+            return cost
+
+        if ':' in token:
+            field, value = token.split(':', 1)
+            if field in QueryIndex.FIELDS:
+                field = QueryIndex.FIELDS[field]
+                if field == 'cost':
+                    return self._cost(value)
+                return self.index.get((field, _normalize(value)), 0)
+
+        return self._word(token)
+
+    def _word(self, token):
+        value = _normalize(token)
+        if value in self.vocabulary:
+            return self.vocabulary[value]
+        # Creatures, Nords...
+        if value.endswith('s') and value[:-1] in self.vocabulary:
+            return self.vocabulary[value[:-1]]
+        return None
+
+    def search(self, text):
+        # Terms are ANDed together, "or" (or |) between two terms ORs just those two
+        tokens = [t for t in re.split(r'[\s,]+', text.strip().lower()) if len(t) > 0]
+        terms = []
+        alternative = False
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            i += 1
+            if token == 'or':
+                alternative = len(terms) > 0
+                continue
+            if token in QueryIndex.STOPWORDS:
+                continue
+
+            # Two word terms like Last Gasp or Dark Elf
+            bits = self._word(token + tokens[i]) if i < len(tokens) else None
+            if bits is not None:
+                i += 1
+            else:
+                bits = self._term(token)
+            if bits is None:
+                raise QueryError('I don\'t know what "{}" means.'.format(token))
+
+            if alternative:
+                terms[-1] |= bits
+            else:
+                terms.append(bits)
+            alternative = False
+
+        if len(terms) == 0:
+            raise QueryError('There is nothing to look for.')
+        result = terms[0]
+        for bits in terms[1:]:
+            result &= bits
+        return result
+
+    @staticmethod
+    def first(bits, limit):
+        # Returns the indexes of the first limit cards in the bitset, and how many cards there are in total
+        total = bin(bits).count('1')
+        indexes = []
+        while bits != 0 and len(indexes) < limit:
+            lowest = bits & -bits
+            indexes.append(lowest.bit_length() - 1)
+            bits ^= lowest
+        return indexes, total
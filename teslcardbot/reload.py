@@ -0,0 +1,94 @@
+from teslcardbot.card import Card
+from teslcardbot.store import image_manifest_filename
+import threading
+import hashlib
+import json
+import os
+
+
+class CardDataWatcher:
+    def __init__(self, path='data/cards.json', interval=30, log=print):
+        self.filename = Card._data_filename(path)
+        self.manifest_filename = image_manifest_filename(self.filename)
+        self.interval = interval
+        self.log = log
+        self.reloads = 0
+        # Nothing has been looked at yet, so the first check compares the files with what Card actually loaded. A
+        # worker forked from a supervisor that loaded the cards long ago might be behind already.
+        self._stat = False
+        self._manifest_stat = False
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _read_stat(filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    @staticmethod
+    def _read_digest(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    def check(self):
+        manifest_reloaded = self._check_manifest()
+        return self._check_cards() or manifest_reloaded
+
+    def _check_manifest(self, force=False):
+        # The image manifest is refreshed on its own, without the cards changing
+        stat = CardDataWatcher._read_stat(self.manifest_filename)
+        if stat == self._manifest_stat and not force:
+            return False
+        self._manifest_stat = stat
+        if not force and CardDataWatcher._read_digest(self.manifest_filename) == Card.MANIFEST_DIGEST:
+            return False
+        Card.load_image_manifest(self.manifest_filename)
+        self.log('Reloaded the image manifest from {}.'.format(self.manifest_filename))
+        return True
+
+    def _check_cards(self):
+        # Cheap check first, the file is only read when its mtime or size changed
+        stat = CardDataWatcher._read_stat(self.filename)
+        if stat is None or stat == self._stat:
+            return False
+        self._stat = stat
+
+        try:
+            with open(self.filename, 'rb') as f:
+                raw = f.read()
+            digest = hashlib.sha1(raw).hexdigest()
+            if digest == Card.DATA_DIGEST:
+                return False
+            data = json.loads(raw.decode('utf-8'))
+            # Built here rather than on the hot path, lookups keep using the old cards meanwhile
+            store = Card._build_store(data)
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            # The file might still be being written to, try again next time
+            self._stat = None
+            self.log('Could not reload {}: {}'.format(self.filename, e))
+            return False
+
+        Card._swap_data(data, store)
+        Card.DATA_DIGEST = digest
+        # New cards usually come with a new manifest
+        self._check_manifest(force=True)
+        self.reloads += 1
+        self.log('Reloaded {} cards from {}.'.format(len(store), self.filename))
+        return True
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
@@ -0,0 +1,174 @@
+from teslcardbot.bot import TESLCardBot
+from teslcardbot.card import Card
+from teslcardbot.replies import ReplyQueue, TokenBucket
+import argparse
+import random
+import json
+import time
+import os
+
+
+class ReplayThing:
+    # Stands in for praw's submissions and comments, replies are kept instead of being posted
+    def __init__(self, kind, id, text='', title='', author='someone', created_utc=0):
+        self.kind = kind
+        self.id = id
+        self.title = title or id
+        self.selftext = text
+        self.body = text
+        self.author = author
+        self.created_utc = created_utc
+        self.saved = False
+        self.replies = []
+
+    @staticmethod
+    def from_json(data):
+        kind = data.get('kind', 'comment')
+        # Submissions keep their text in selftext on Reddit, but any of the three will do
+        text = data.get('selftext' if kind == 'submission' else 'body', data.get('body', data.get('text', '')))
+        return ReplayThing(kind, data['id'], text, title=data.get('title', ''), author=data.get('author', 'someone'),
+                           created_utc=data.get('created_utc', 0))
+
+    def to_json(self):
+        text = 'selftext' if self.kind == 'submission' else 'body'
+        return {'kind': self.kind, 'id': self.id, 'title': self.title, text: self.body, 'author': self.author,
+                'created_utc': self.created_utc}
+
+    def reply(self, response):
+        self.replies.append(response)
+
+    add_comment = reply
+
+    def save(self):
+        self.saved = True
+
+
+def load_stream(path):
+    with open(path) as f:
+        return [ReplayThing.from_json(json.loads(line)) for line in f if len(line.strip()) > 0]
+
+
+def save_stream(things, path):
+    with open(path, 'w') as f:
+        for thing in things:
+            f.write(json.dumps(thing.to_json()) + '\n')
+
+
+def synthetic_stream(count, seed=0, rate=1, density=0.02, words=50):
+    # Mostly comments arriving about rate per second, like a busy subreddit would
+    from teslcardbot.benchmarks.run import make_comment
+    Card.preload_card_data()
+    rng = random.Random(seed)
+    things = []
+    created = 1500000000
+    for i in range(count):
+        created += rng.expovariate(rate)
+        kind = 'submission' if rng.random() < 0.1 else 'comment'
+        things.append(ReplayThing(kind, '{}{}'.format(kind[0], i), make_comment(rng, rng.randint(1, words), density),
+                                  created_utc=created))
+    return things
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    ms = [v * 1000 for v in values]
+    return {'p50': ms[len(ms) // 2],
+            'p90': ms[min(len(ms) - 1, int(len(ms) * 0.9))],
+            'p99': ms[min(len(ms) - 1, int(len(ms) * 0.99))],
+            'max': ms[-1]}
+
+
+class Replay:
+    def __init__(self, bot, things, speed=None, reply_rate=None):
+        self.bot = bot
+        self.things = sorted(things, key=lambda t: t.created_utc)
+        # How many times faster than it was recorded the stream is replayed, None for as fast as possible
+        self.speed = speed
+        # Replies per second the reply queue is allowed to post, None for no limit
+        self.reply_rate = reply_rate
+
+    def _bucket(self):
+        if self.reply_rate is None:
+            return TokenBucket(rate=1e9, capacity=1e9)
+        return TokenBucket(rate=self.reply_rate, capacity=1)
+
+    def run(self):
+        # Nothing here talks to Reddit, but the bot still wants to know who it is
+        os.environ.setdefault('REDDIT_USERNAME', 'TESLCardBot')
+        arrived = {}
+        done = {}
+
+        def on_done(item):
+            done[item.id] = time.perf_counter()
+
+        self.bot.replies = ReplyQueue(self.bot, on_done=on_done, bucket=self._bucket()).start()
+        first = self.things[0].created_utc if len(self.things) > 0 else 0
+        start = time.perf_counter()
+        try:
+            for thing in self.things:
+                if self.speed is not None:
+                    delay = (thing.created_utc - first) / self.speed - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                arrived[thing.id] = time.perf_counter()
+                if thing.kind == 'submission':
+                    queued = self.bot._process_submission(thing)
+                else:
+                    queued = self.bot._process_comment(thing)
+                if not queued:
+                    done[thing.id] = time.perf_counter()
+            self.bot.replies.join()
+        finally:
+            self.bot.replies.stop()
+        elapsed = time.perf_counter() - start
+
+        replied = [t for t in self.things if len(t.replies) > 0]
+        return {'items': len(self.things),
+                'replies': sum(len(t.replies) for t in self.things),
+                'seconds': elapsed,
+                'items_per_sec': len(self.things) / elapsed if elapsed > 0 else float('inf'),
+                'latency_ms': _percentiles([done[t.id] - arrived[t.id] for t in self.things if t.id in done]),
+                'reply_latency_ms': _percentiles([done[t.id] - arrived[t.id] for t in replied if t.id in done])}
+
+
+def report(results):
+    print('{} items, {} replies in {:.2f}s ({:.1f} items/s)'.format(results['items'], results['replies'],
+                                                                    results['seconds'], results['items_per_sec']))
+    for name in ['latency_ms', 'reply_latency_ms']:
+        p = results[name]
+        if p is not None:
+            print('{:<18} p50 {:>9.2f}  p90 {:>9.2f}  p99 {:>9.2f}  max {:>9.2f}'.format(
+                name, p['p50'], p['p90'], p['p99'], p['max']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a stream of submissions and comments through the bot, '
+                                                 'without touching Reddit.')
+    parser.add_argument('stream', help='JSONL file with one submission or comment per line.')
+    parser.add_argument('--generate', type=int, default=None,
+                        help='Write this many synthetic items to the stream file instead of replaying it.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic items.')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='Replay this many times faster than recorded, as fast as possible by default.')
+    parser.add_argument('--reply_rate', type=float, default=None,
+                        help='Replies per second the bot may post, unlimited by default.')
+    parser.add_argument('--check_images', action='store_true',
+                        help='Check card images on the image host instead of assuming they all exist.')
+    parser.add_argument('-o', '--output', default=None, help='Where should the results be saved as JSON?')
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        save_stream(synthetic_stream(args.generate, seed=args.seed), args.stream)
+        print('Wrote {} items to {}.'.format(args.generate, args.stream))
+    else:
+        if not args.check_images:
+            Card._check_img = staticmethod(lambda url: True)
+        bot = TESLCardBot(author='Replay', target_sub='Replay')
+        bot.log = lambda msg: None
+        results = Replay(bot, load_stream(args.stream), speed=args.speed, reply_rate=args.reply_rate).run()
+        report(results)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
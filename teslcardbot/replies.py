@@ -0,0 +1,218 @@
+from teslcardbot.metrics import REGISTRY, ERRORS
+import threading
+import requests
+import heapq
+import praw
+import time
+
+
+def is_transient(e):
+    # Deleted or locked threads won't get any better by trying again
+    if isinstance(e, (praw.errors.Forbidden, praw.errors.NotFound)):
+        return False
+    return isinstance(e, (praw.errors.HTTPException, requests.exceptions.RequestException))
+
+
+class TokenBucket:
+    def __init__(self, rate=0.5, capacity=5, clock=time.monotonic):
+        # Tokens added per second, and how many can be saved up for a burst
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self._updated = clock()
+        self._paused_until = None
+        self._lock = threading.Lock()
+
+    def take(self):
+        # Returns 0 if a token was taken, otherwise how many seconds to wait before trying again
+        with self._lock:
+            now = self.clock()
+            if self._paused_until is not None:
+                if now < self._paused_until:
+                    return self._paused_until - now
+                self._paused_until = None
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        # Reddit asked us to slow down, so nothing goes out until then and the bucket starts over empty
+        with self._lock:
+            until = self.clock() + seconds
+            if self._paused_until is None or until > self._paused_until:
+                self._paused_until = until
+            self.tokens = 0
+            self._updated = self._paused_until
+
+
+class PendingReply:
+    def __init__(self, kind, item, cards, response):
+        self.kind = kind
+        self.item = item
+        self.cards = cards
+        self.response = response
+        self.attempts = 0
+        # Set once the reply is up, so that a failed save() is retried without posting twice
+        self.posted = False
+        self.not_before = 0
+        self.created = getattr(item, 'created_utc', None) or 0
+
+
+class ReplyQueue:
+    def __init__(self, bot, on_done=None, bucket=None, max_attempts=3, retry_delay=5, call=None,
+                 clock=time.monotonic, on_queued=None):
+        self.bot = bot
+        # Called with everything that was queued, so that it can be kept somewhere safe until it's done
+        self.on_queued = on_queued
+        # Called with the item once it's been replied to and saved, or given up on
+        self.on_done = on_done
+        self.bucket = TokenBucket(clock=clock) if bucket is None else bucket
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Every call to Reddit goes through this, so callers can keep praw on a single thread
+        self.call = (lambda f, *args: f(*args)) if call is None else call
+        self.clock = clock
+        self.posted = 0
+        self.failed = 0
+        # Oldest mentions first, they've been waiting the longest
+        self._ready = []
+        self._delayed = []
+        self._ids = set()
+        self._seq = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        REGISTRY.gauge('teslcardbot_pending_replies', 'Replies waiting to be posted.',
+                       function=lambda: [({}, len(self))])
+
+    def put(self, kind, item, cards, response):
+        with self._cond:
+            if item.id in self._ids:
+                return
+            self._ids.add(item.id)
+            if self.on_queued is not None:
+                self.on_queued(kind, item, cards, response)
+            self._push(PendingReply(kind, item, cards, response))
+            self._cond.notify_all()
+
+    def _push(self, reply):
+        self._seq += 1
+        if reply.not_before > self.clock():
+            self._delayed.append(reply)
+        else:
+            heapq.heappush(self._ready, (reply.created, self._seq, reply))
+
+    def _promote(self):
+        now = self.clock()
+        due = [r for r in self._delayed if r.not_before <= now]
+        if len(due) > 0:
+            self._delayed = [r for r in self._delayed if r.not_before > now]
+            for reply in due:
+                self._push(reply)
+
+    def _next_delay(self):
+        if len(self._delayed) == 0:
+            return None
+        return max(0, min(r.not_before for r in self._delayed) - self.clock())
+
+    def post_next(self):
+        # Posts the oldest pending reply if the rate limit allows it, returns how long to wait before calling again
+        with self._cond:
+            self._promote()
+            if len(self._ready) == 0:
+                return self._next_delay()
+            wait = self.bucket.take()
+            if wait > 0:
+                return wait
+            _, _, reply = heapq.heappop(self._ready)
+
+        try:
+            self._post(reply)
+        finally:
+            with self._cond:
+                self._cond.notify_all()
+        return 0
+
+    def _post(self, reply):
+        try:
+            if not reply.posted:
+                self.call(self.bot._post_reply, reply.kind, reply.item, reply.response)
+                reply.posted = True
+            self.call(reply.item.save)
+        except praw.errors.RateLimitExceeded as e:
+            # Doesn't count as an attempt, the reply goes out as soon as Reddit lets us
+            self.bot.log('Rate limited by Reddit, waiting {} seconds.'.format(e.sleep_time))
+            self.bucket.pause(e.sleep_time)
+            self._retry(reply)
+            return
+        except Exception as e:
+            reply.attempts += 1
+            if is_transient(e) and reply.attempts < self.max_attempts:
+                reply.not_before = self.clock() + self.retry_delay * 2 ** (reply.attempts - 1)
+                self.bot.log('Could not reply to {}, trying again later: {}'.format(reply.item.id, e))
+                self._retry(reply)
+                return
+            # Marked as done anyway, otherwise the next poll would queue it again and fail the same way
+            ERRORS.inc(stage='reply_dropped')
+            self.failed += 1
+            self.bot.log('Giving up on replying to {}: {}'.format(reply.item.id, e))
+        else:
+            self.posted += 1
+            self.bot.log('Done replying to {} and saved it.'.format(reply.item.id))
+        self._finish(reply)
+
+    def _retry(self, reply):
+        with self._cond:
+            self._push(reply)
+
+    def _finish(self, reply):
+        if self.on_done is not None:
+            self.on_done(reply.item)
+        with self._cond:
+            self._ids.discard(reply.item.id)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                seq = self._seq
+            wait = self.post_next()
+            if wait is None or wait > 0:
+                with self._cond:
+                    # Don't go to sleep if something was queued in the meantime
+                    if not self._stopping and seq == self._seq:
+                        self._cond.wait(wait)
+
+    def join(self, timeout=None):
+        # Waits until every reply has been posted or given up on
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while len(self._ids) > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Anything still pending isn't marked as done, so it's picked up again after a restart
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def __contains__(self, id):
+        with self._cond:
+            return id in self._ids
+
+    def __len__(self):
+        with self._cond:
+            return len(self._ids)
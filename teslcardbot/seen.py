@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import threading
+import json
+import os
+
+
+class SeenSet:
+    def __init__(self, capacity=1000, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.added = 0
+        self.evicted = 0
+        # Keeps insertion order, so the oldest ids are evicted first
+        self._ids = OrderedDict()
+        # Ids can be added from the thread that posts replies while the bot is polling
+        self._lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def add(self, id):
+        with self._lock:
+            if id in self._ids:
+                return
+            self._ids[id] = None
+            self.added += 1
+            if len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self):
+        return {'size': len(self._ids),
+                'capacity': self.capacity,
+                'added': self.added,
+                'evicted': self.evicted,
+                'eviction_rate': self.evicted / self.added if self.added > 0 else 0.0}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                ids = json.load(f)
+        except (IOError, ValueError):
+            return
+        for id in ids[-self.capacity:]:
+            self._ids[id] = None
+
+    def save(self):
+        if self.path is None:
+            return
+        # Write to a temporary file first so a crash can't leave a truncated file behind
+        tmp = '{}.tmp'.format(self.path)
+        with self._lock:
+            ids = list(self._ids)
+        with open(tmp, 'w') as f:
+            json.dump(ids, f)
+        os.replace(tmp, self.path)
+
+    def __contains__(self, id):
+        return id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._ids))
@@ -0,0 +1,125 @@
+from teslcardbot.fuzzy import TrigramIndex
+from teslcardbot.query import QueryIndex
+from collections import namedtuple
+import hashlib
+import pickle
+import sys
+import os
+
+
+# Everything a reply needs to know about a card, derived once from its JSON entry when the data is loaded
+CardRecord = namedtuple('CardRecord', ['name', 'escaped_name', 'img_url', 'type', 'attributes', 'rarity', 'unique',
+                                       'cost', 'power', 'health', 'race', 'text', 'keywords'])
+
+COMPILED_MAGIC = b'TESLCDB'
+# Bump this whenever the layout of CardStore or CardRecord changes
+COMPILED_FORMAT_VERSION = 3
+
+
+class CardStore:
+    def __init__(self, records, source=None):
+        self.records = tuple(records)
+        # The raw data the records were parsed from
+        self.source = source
+        self.prefix_index = CardStore._build_prefix_index(self.records)
+        self.fuzzy_index = TrigramIndex(record.escaped_name for record in self.records)
+        self.keyword_index = CardStore._build_keyword_index(self.records)
+        self.query_index = QueryIndex(self.records)
+
+    @staticmethod
+    def _build_prefix_index(records):
+        # Maps every prefix of every escaped card name to (match count, index of the first match)
+        index = {}
+        for i, record in enumerate(records):
+            escaped = record.escaped_name
+            for j in range(len(escaped) + 1):
+                prefix = escaped[:j]
+                if prefix in index:
+                    count, first = index[prefix]
+                    index[prefix] = (count + 1, first)
+                else:
+                    index[prefix] = (1, i)
+        return index
+
+    @staticmethod
+    def _build_keyword_index(records):
+        # Maps every keyword to the indexes of the cards that have it, in order
+        index = {}
+        for i, record in enumerate(records):
+            for keyword in record.keywords:
+                index.setdefault(keyword.lower(), []).append(i)
+        return {keyword: tuple(indexes) for keyword, indexes in index.items()}
+
+    def find_keyword(self, keyword):
+        return [self.records[i] for i in self.keyword_index.get(keyword.lower(), ())]
+
+    def search(self, query, limit):
+        # Returns the first limit cards matching the query and how many match in total, raises QueryError
+        indexes, total = QueryIndex.first(self.query_index.search(query), limit)
+        return [self.records[i] for i in indexes], total
+
+    def find_prefix(self, prefix):
+        return self.prefix_index.get(prefix, (0, None))
+
+    def find_fuzzy(self, name, threshold):
+        return self.fuzzy_index.best(name, threshold)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+def compiled_filename(filename):
+    return os.path.splitext(filename)[0] + '.bin'
+
+
+def image_manifest_filename(filename):
+    return os.path.join(os.path.dirname(filename), 'images.json')
+
+
+def code_digest(modules, values=()):
+    # The records and indexes depend on the code and settings that built them just as much as on the JSON
+    digest = hashlib.sha1()
+    for module in (__name__, TrigramIndex.__module__, QueryIndex.__module__) + tuple(modules):
+        with open(sys.modules[module].__file__, 'rb') as f:
+            digest.update(f.read())
+    for value in values:
+        digest.update(repr(value).encode('utf-8'))
+    return digest.digest()
+
+
+def _compiled_header(raw, code):
+    # Ties the compiled database to its format, the exact JSON it was compiled from and the code that compiled it
+    return COMPILED_MAGIC + bytes([COMPILED_FORMAT_VERSION]) + hashlib.sha1(raw).digest() + code
+
+
+def save_compiled(store, raw, output, code):
+    # Write to a temporary file first so a crash can't leave a truncated database behind
+    tmp = '{}.tmp'.format(output)
+    with open(tmp, 'wb') as f:
+        f.write(_compiled_header(raw, code))
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, output)
+
+
+def load_compiled(raw, filename, code):
+    # Returns None when there's no compiled database or it doesn't match the JSON anymore
+    try:
+        with open(filename, 'rb') as f:
+            compiled = f.read()
+    except IOError:
+        return None
+
+    header = _compiled_header(raw, code)
+    if compiled[:len(header)] != header:
+        return None
+    try:
+        store = pickle.loads(compiled[len(header):])
+    except (pickle.UnpicklingError, AttributeError, EOFError, ImportError, IndexError):
+        return None
+    return store if isinstance(store, CardStore) else None
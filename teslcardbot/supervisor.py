@@ -0,0 +1,125 @@
+from teslcardbot.bot import TESLCardBot, exit_on_sigterm
+from teslcardbot.card import Card
+from teslcardbot.metrics import MetricsServer, MetricsLogger
+from teslcardbot.reload import CardDataWatcher
+from multiprocessing import Process
+import time
+
+
+def shard(subs, workers):
+    shards = [[] for _ in range(min(workers, len(subs)))]
+    for i, sub in enumerate(subs):
+        shards[i % len(shards)].append(sub)
+    return shards
+
+
+def run_worker(subs, author='Anonymous', engine='sync', seen_path=None, checkpoint_path=None, metrics_port=None,
+               metrics_log_interval=None, reload_interval=None):
+    # A watcher started before forking would only ever reload the supervisor's cards
+    if reload_interval is not None:
+        watcher = CardDataWatcher(interval=reload_interval)
+        # Catches up with whatever changed since the supervisor loaded the cards, before the first reply
+        watcher.check()
+        watcher.start()
+    # Metrics live in each worker's own registry, so every worker serves and logs its own
+    if metrics_port is not None:
+        MetricsServer(port=metrics_port).start()
+    if metrics_log_interval is not None:
+        MetricsLogger(interval=metrics_log_interval,
+                      log=lambda msg: print('Worker {} # {}'.format('+'.join(subs), msg))).start()
+
+    # Reddit serves several subreddits at once as a multireddit, so one bot is enough for the whole shard
+    bot = TESLCardBot(author=author, target_sub='+'.join(subs))
+    # Workers end through os._exit, which skips atexit, so whatever the image cache hasn't written yet is written here
+    exit_on_sigterm()
+    try:
+        if engine == 'async':
+            bot.start_async(batch_limit=10, buffer_size=1000, seen_path=seen_path, checkpoint_path=checkpoint_path)
+        else:
+            bot.start(batch_limit=10, buffer_size=1000, seen_path=seen_path, checkpoint_path=checkpoint_path)
+    finally:
+        Card.IMAGE_CACHE.flush()
+
+
+class Supervisor:
+    def __init__(self, subs, workers=2, author='Anonymous', engine='sync', seen_path=None,
+                 check_interval=5, max_restarts=3, restart_window=600, target=run_worker, checkpoint_path=None,
+                 backoff=30, max_backoff=3600, metrics_port=None, metrics_log_interval=None, reload_interval=None):
+        self.subs = subs
+        self.author = author
+        self.engine = engine
+        self.seen_path = seen_path
+        self.checkpoint_path = checkpoint_path
+        # Worker i serves its metrics on metrics_port + i
+        self.metrics_port = metrics_port
+        self.metrics_log_interval = metrics_log_interval
+        self.reload_interval = reload_interval
+        self.check_interval = check_interval
+        # A worker that died more often than this in a row waits before being restarted, twice as long every time.
+        # Its subreddits are never handed to the other workers, in case one of them is what kills it.
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Workers that ran for this many seconds before dying start over with a clean record
+        self.restart_window = restart_window
+        self.target = target
+        # Shards never change, so every worker keeps finding its own seen and checkpoint files
+        self.shards = shard(subs, workers)
+        self.restarts = [0] * len(self.shards)
+        self.processes = [None] * len(self.shards)
+        self.started = [None] * len(self.shards)
+        self.retry_at = [0] * len(self.shards)
+
+    def log(self, msg):
+        print('Supervisor # {}'.format(msg))
+
+    def _spawn(self, i):
+        shard = self.shards[i]
+        # Every worker keeps its own files, named after its shard
+        seen_path = None if self.seen_path is None else '{}.{}'.format(self.seen_path, '+'.join(shard))
+        checkpoint_path = None if self.checkpoint_path is None else \
+            '{}.{}'.format(self.checkpoint_path, '+'.join(shard))
+        metrics_port = None if self.metrics_port is None else self.metrics_port + i
+        p = Process(target=self.target, args=(shard,),
+                    kwargs={'author': self.author, 'engine': self.engine, 'seen_path': seen_path,
+                            'checkpoint_path': checkpoint_path, 'metrics_port': metrics_port,
+                            'metrics_log_interval': self.metrics_log_interval,
+                            'reload_interval': self.reload_interval})
+        p.daemon = True
+        p.start()
+        self.processes[i] = p
+        self.started[i] = time.time()
+        self.log('Worker {} is monitoring {}.'.format(i, ', '.join(shard)))
+
+    def check(self):
+        for i in range(len(self.shards)):
+            p = self.processes[i]
+            if p is None or p.is_alive():
+                continue
+            self.log('Worker {} died with exit code {}.'.format(i, p.exitcode))
+            if time.time() - self.started[i] > self.restart_window:
+                self.restarts[i] = 0
+            self.restarts[i] += 1
+            if self.restarts[i] > self.max_restarts:
+                delay = min(self.max_backoff, self.backoff * 2 ** (self.restarts[i] - self.max_restarts - 1))
+                self.retry_at[i] = time.time() + delay
+                self.log('Worker {} keeps dying, waiting {}s before restarting it.'.format(i, delay))
+            self.processes[i] = None
+
+        for i in range(len(self.shards)):
+            if self.processes[i] is None and time.time() >= self.retry_at[i]:
+                self._spawn(i)
+
+    def start(self):
+        # Loaded before forking so that every worker shares the same card data
+        Card.preload_card_data()
+        for i in range(len(self.shards)):
+            self._spawn(i)
+        try:
+            while len(self.shards) > 0:
+                time.sleep(self.check_interval)
+                self.check()
+        finally:
+            for p in self.processes:
+                if p is not None:
+                    p.terminate()
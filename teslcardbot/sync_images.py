@@ -0,0 +1,80 @@
+from teslcardbot.card import Card, remove_duplicates
+from teslcardbot.store import image_manifest_filename
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
+import json
+import time
+import os
+
+
+def scan_directory(names, directory):
+    # Images are expected to be named like on the image host, <escaped name>.png
+    images = {}
+    for name in names:
+        try:
+            with open(os.path.join(directory, '{}.png'.format(name)), 'rb') as f:
+                data = f.read()
+        except IOError:
+            continue
+        images[name] = {'size': len(data), 'sha1': hashlib.sha1(data).hexdigest()}
+    return images, []
+
+
+def crawl(names, workers=8):
+    from teslcardbot.httpclient import HttpClient
+    client = HttpClient()
+    urls = [Card.CARD_IMAGE_BASE_URL.format(name) for name in names]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(client.image_exists, urls))
+    images = {name: {} for name, exists in zip(names, results) if exists is True}
+    # Left out of the manifest entirely, so that the bot still checks them live
+    unreachable = [name for name, exists in zip(names, results) if exists is None]
+    return images, unreachable
+
+
+def build_manifest(names, images, unreachable=()):
+    unreachable = set(unreachable)
+    return {'base_url': Card.CARD_IMAGE_BASE_URL,
+            'generated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'images': images,
+            'missing': [name for name in names if name not in images and name not in unreachable]}
+
+
+def save_manifest(manifest, filename):
+    # Write to a temporary file first so a crash can't leave a truncated manifest behind
+    tmp = '{}.tmp'.format(filename)
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Records which card images exist, so that the bot never has to '
+                                                 'check them while replying.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-d', '--dir', default=None, help='A local mirror of the card images.')
+    source.add_argument('--crawl', action='store_true', help='Check every card image on the image host instead.')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='How many images to check at once when crawling.')
+    parser.add_argument('-o', '--output', default=None, help='Where to write the manifest, next to cards.json by default.')
+    args = parser.parse_args()
+    if args.dir is not None and not os.path.isdir(args.dir):
+        parser.error('{} is not a directory.'.format(args.dir))
+
+    Card.preload_card_data()
+    names = remove_duplicates(record.escaped_name for record in Card.STORE)
+    if args.crawl:
+        images, unreachable = crawl(names, workers=args.workers)
+    else:
+        images, unreachable = scan_directory(names, args.dir)
+
+    manifest = build_manifest(names, images, unreachable)
+    output = image_manifest_filename(Card._data_filename()) if args.output is None else args.output
+    save_manifest(manifest, output)
+
+    print('Wrote {} with {} of {} card images.'.format(output, len(images), len(names)))
+    card_names = {record.escaped_name: record.name for record in Card.STORE}
+    if len(manifest['missing']) > 0:
+        print('Missing images: {}'.format(', '.join(card_names[name] for name in manifest['missing'])))
+    if len(unreachable) > 0:
+        print('Could not check: {}'.format(', '.join(card_names[name] for name in unreachable)))
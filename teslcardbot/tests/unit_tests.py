@@ -1,5 +1,34 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.request import urlopen
+from multiprocessing import Process
+import subprocess
+import threading
 import unittest
+import tempfile
+import shutil
+import hashlib
+import random
+import time
+import json
+import sys
+import os
+import praw
 from teslcardbot.bot import TESLCardBot, Card
+from teslcardbot.cache import LRUCache, ImageCache
+from teslcardbot.httpclient import HttpClient, CircuitBreaker
+from teslcardbot.seen import SeenSet
+from teslcardbot.engine import AsyncEngine, AdaptiveInterval
+from teslcardbot.supervisor import Supervisor, shard, run_worker
+from teslcardbot.metrics import Registry, MetricsServer, MetricsLogger
+from teslcardbot.reload import CardDataWatcher
+from teslcardbot.replies import ReplyQueue, TokenBucket
+from teslcardbot.fetcher import StreamFetcher
+from teslcardbot.checkpoint import Checkpoint
+from teslcardbot.sync_images import scan_directory, build_manifest, save_manifest
+from teslcardbot.replay import Replay, ReplayThing, load_stream, save_stream
+from teslcardbot.compile_cards import compile_cards
+from teslcardbot.store import load_compiled
+from teslcardbot.query import QueryError
 
 
 class TestParsingFunctions(unittest.TestCase):
@@ -15,6 +44,23 @@ class TestParsingFunctions(unittest.TestCase):
         # Make sure the repetition avoidance works
         self.assertEqual(TESLCardBot.find_card_mentions('{{Test}} {{Blood Dragon}} ' * 4), ['Test', 'Blood Dragon'])
 
+    def test_find_card_mentions_like_regex(self):
+        rng = random.Random(42)
+        for _ in range(5000):
+            s = ''.join(rng.choice('{{}}ab\n') for _ in range(rng.randint(0, 14)))
+            expected = TESLCardBot.CARD_MENTION_REGEX.findall(s)
+            self.assertEqual(TESLCardBot.find_card_mentions(s), [m for i, m in enumerate(expected) if m not in expected[:i]])
+
+    def test_find_card_mentions_limits(self):
+        self.assertEqual(TESLCardBot.find_card_mentions('{{' + 'a' * 100000), [])
+        self.assertEqual(TESLCardBot.find_card_mentions('{{' * 1000 + '}}'), [])
+        self.assertEqual(len(TESLCardBot.find_card_mentions(' '.join('{{{{{}}}}}'.format(i) for i in range(100)))),
+                         TESLCardBot.MAX_MENTIONS)
+        # Took seconds when every '{{' searched for the closing braces all over again
+        start = time.perf_counter()
+        self.assertEqual(TESLCardBot.find_card_mentions('{{\n' * 80000 + '}}'), [])
+        self.assertLess(time.perf_counter() - start, 0.5)
+
     def test_escape_card_name(self):
         self.assertEqual(Card._escape_name('Blood Dragon'), 'blooddragon')
         self.assertEqual(Card._escape_name('Bl-ood, _-"\' Drag;on'), 'blooddragon')
@@ -41,6 +87,85 @@ class TestParsingFunctions(unittest.TestCase):
         self.assertEqual(Card._fetch_data_partial('Storm Atronach'), None)
         self.assertEqual(Card._fetch_data_partial('Storm')['name'], 'Stormhold Henchman')
 
+    def test_prefix_index(self):
+        self.assertEqual(Card.STORE.find_prefix(''), (len(Card.JSON_DATA), 0))
+        self.assertEqual(Card.STORE.find_prefix('tyr')[0], 1)
+        # Replacing the data directly must not leave a stale index behind
+        data = Card.JSON_DATA
+        try:
+            Card.JSON_DATA = [{'name': 'Tyrant', 'cost': '1'}, {'name': 'Tyr', 'cost': '4'}]
+            self.assertEqual(Card._fetch_data_partial('tyr')['name'], 'Tyrant')
+            self.assertEqual(Card._fetch_data_partial('tyra')['name'], 'Tyrant')
+        finally:
+            Card.JSON_DATA = data
+
+    def test_keyword_index(self):
+        guards = Card.STORE.find_keyword('guard')
+        self.assertIn('Tyr', [r.name for r in guards])
+        self.assertTrue(all('Guard' in r.keywords for r in guards))
+        self.assertEqual(len(guards), sum(1 for r in Card.STORE if 'Guard' in r.keywords))
+        self.assertEqual(Card.STORE.find_keyword('Last Gasp'), Card.STORE.find_keyword('last gasp'))
+        self.assertEqual(Card.STORE.find_keyword('Bees'), [])
+
+    def test_query_index(self):
+        records, total = Card.STORE.search('all 3-cost Willpower creatures with Guard', limit=10)
+        self.assertEqual(total, sum(1 for r in Card.STORE if r.cost == 3 and 'Willpower' in r.attributes and
+                                    r.type == 'creature' and 'Guard' in r.keywords))
+        self.assertTrue(all(r.cost == 3 and 'Guard' in r.keywords for r in records))
+
+        records, total = Card.STORE.search('willpower or strength 7+ actions', limit=3)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(total, sum(1 for r in Card.STORE if r.cost >= 7 and r.type == 'action' and
+                                    ({'Willpower', 'Strength'} & set(r.attributes))))
+        # Two word terms, and fields given explicitly
+        self.assertEqual(Card.STORE.search('last gasp dark elf', limit=100),
+                         Card.STORE.search('keyword:lastgasp race:darkelf', limit=100))
+        records, total = Card.STORE.search('cost:2-3 epic|legendary', limit=100)
+        self.assertTrue(all(r.cost in (2, 3) and r.rarity in ('Epic', 'Legendary') for r in records))
+        self.assertEqual(len(records), total)
+        self.assertRaises(QueryError, Card.STORE.search, 'creatures with bees', 10)
+        self.assertRaises(QueryError, Card.STORE.search, 'all cards', 10)
+
+    def test_card_records(self):
+        tyr = Card._fetch_record_partial('tyr')
+        self.assertEqual((tyr.cost, tyr.power, tyr.health), (4, 5, 4))
+        self.assertEqual(tyr.attributes, ('Strength', 'Willpower'))
+        self.assertEqual(tyr.keywords, ('Breakthrough', 'Prophecy', 'Guard'))
+        self.assertTrue(tyr.unique)
+        self.assertEqual(tyr.img_url, 'http://www.legends-decks.com/img_cards/tyr.png')
+
+        ward = Card._fetch_record_partial('lesser ward')
+        self.assertEqual(ward.attributes, ('Intelligence',))
+        self.assertFalse(ward.unique)
+
+        item = Card._parse_record({'name': 'Bee Sword', 'type': 'item', 'attribute_1': 'neutral', 'cost': '1',
+                                   'attack': '0', 'health': '0', 'text': '+2/+1. Summon: Release the bees.'})
+        self.assertEqual((item.power, item.health, item.keywords), (2, 1, ('Summon',)))
+
+    def test_fetch_record_fuzzy(self):
+        self.assertEqual(Card._fetch_record_fuzzy('generl tulius').name, 'General Tullius')
+        self.assertEqual(Card._fetch_record_fuzzy('brton conjuror').name, 'Breton Conjurer')
+        self.assertEqual(Card._fetch_record_fuzzy('Storm Atronach'), None)
+        self.assertEqual(Card._fetch_record_fuzzy('xyz'), None)
+        # Typos are only looked up when the name can't be matched otherwise
+        self.assertEqual(Card.get_info('tyrr', check_image=False).name, 'Tyr')
+        self.assertEqual(Card.get_info('Storm', check_image=False).name, Card._fetch_data_partial('Storm')['name'])
+
+    def test_render_cache(self):
+        card = Card('Bee', 'bee.png', type='creature', text='Charge', cost=1, power=1, health=1)
+        render_cache = Card.RENDER_CACHE
+        Card.RENDER_CACHE = LRUCache()
+        try:
+            self.assertEqual(str(card), '[📷](bee.png) Bee | Creature | 1 - 1/1 | Charge | Neutral | Common | Charge')
+            self.assertEqual(str(card),
+                             str(Card('Bee', 'bee.png', type='creature', text='Charge', cost=1, power=1, health=1)))
+            self.assertEqual(Card.RENDER_CACHE.stats(), {'size': 1, 'hits': 2, 'misses': 1})
+
+            card.ROW_TEMPLATE = Card.TOOLTIP_ROW_TEMPLATE
+            self.assertEqual(str(card), '[📷](bee.png "Charge") Bee | Creature | 1 - 1/1 | Charge | Neutral | Common')
+        finally:
+            Card.RENDER_CACHE = render_cache
+
     def test_get_info(self):
         Card.preload_card_data()
 
@@ -61,5 +186,979 @@ class TestParsingFunctions(unittest.TestCase):
                                                      '| Unique Legendary | +4/+4. Summon: Destroy an enemy Undead.')
 
 
+class TestCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_cards(self, *names):
+        # Writes a cards.json with a plain 1/1 creature for every name
+        path = os.path.join(self.tmp_dir, 'cards.json')
+        card = {'type': 'creature', 'attribute_1': 'neutral', 'rarity': 'Common', 'isunique': False,
+                'cost': '1', 'attack': '1', 'health': '1', 'race': '', 'text': ''}
+        with open(path, 'w') as f:
+            json.dump([dict(card, name=name) for name in names], f)
+        return path
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is now the least recently used entry
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 2, 'misses': 1})
+        # Expired entries count as misses
+        cache.set('a', 1, ttl=-1)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_image_cache(self):
+        checked = []
+
+        def check(url):
+            checked.append(url)
+            return url.endswith('.png')
+
+        path = os.path.join(self.tmp_dir, 'images.json')
+        cache = ImageCache(path=path)
+        self.assertTrue(cache.exists('tyr.png', check))
+        self.assertTrue(cache.exists('tyr.png', check))
+        self.assertFalse(cache.exists('tyr.gif', check))
+        self.assertFalse(cache.exists('tyr.gif', check))
+        self.assertEqual(checked, ['tyr.png', 'tyr.gif'])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        # Nothing is written until the next flush
+        self.assertFalse(os.path.exists(path))
+        cache.flush()
+
+        # A restarted worker picks up the previous results from disk
+        cache = ImageCache(path=path)
+        self.assertTrue(cache.exists('tyr.png', check))
+        self.assertFalse(cache.exists('tyr.gif', check))
+        self.assertEqual(len(checked), 2)
+
+        cache = ImageCache(path=path, negative_ttl=-1)
+        cache.set('tyr.gif', False)
+        self.assertFalse(cache.exists('tyr.gif', check))
+        self.assertEqual(len(checked), 3)
+
+        # Writes are batched, a check that comes after the flush interval writes everything before it too
+        cache = ImageCache(path=path, flush_interval=0)
+        cache.set('lesserward.png', True)
+        self.assertTrue(ImageCache(path=path).exists('lesserward.png', check))
+        self.assertEqual(len(checked), 3)
+
+    def test_shared_image_cache(self):
+        # Workers sharing a cache file keep each other's checks instead of overwriting them
+        path = os.path.join(self.tmp_dir, 'images.json')
+        first = ImageCache(path=path)
+        second = ImageCache(path=path)
+        first.set('tyr.png', True)
+        second.set('dawnbreaker.png', True)
+        first.flush()
+        second.flush()
+        cache = ImageCache(path=path)
+        self.assertTrue(cache.get('tyr.png'))
+        self.assertTrue(cache.get('dawnbreaker.png'))
+        self.assertEqual(os.listdir(self.tmp_dir), ['images.json'])
+
+    def test_card_data_watcher(self):
+        path = self._write_cards('Bee')
+        try:
+            Card.preload_card_data(path)
+            watcher = CardDataWatcher(path, log=lambda msg: None)
+            self.assertFalse(watcher.check())
+            self.assertEqual(Card.get_info('bee', check_image=False).name, 'Bee')
+
+            self._write_cards('Bee', 'Beehive')
+            os.utime(path, (0, 0))
+            self.assertTrue(watcher.check())
+            self.assertEqual(Card.get_info('beeh', check_image=False).name, 'Beehive')
+
+            # A broken file keeps the old cards around
+            with open(path, 'w') as f:
+                f.write('[{"name": ')
+            os.utime(path, (1, 1))
+            self.assertFalse(watcher.check())
+            self.assertEqual(len(Card.STORE), 2)
+
+            # A refreshed image manifest is picked up on its own
+            save_manifest(build_manifest(['bee', 'beehive'], {'bee': {}}), os.path.join(self.tmp_dir, 'images.json'))
+            self.assertTrue(watcher.check())
+            self.assertEqual(Card.IMAGE_MANIFEST, {Card.CARD_IMAGE_BASE_URL.format('bee'): True,
+                                                   Card.CARD_IMAGE_BASE_URL.format('beehive'): False})
+            self.assertFalse(watcher.check())
+        finally:
+            Card.preload_card_data()
+
+    def test_card_data_watcher_catches_up(self):
+        # Like a worker restarted after the cards changed, forked from a supervisor that still has the old ones
+        path = self._write_cards('Bee')
+        try:
+            Card.preload_card_data(path)
+            self._write_cards('Bee', 'Beehive')
+            save_manifest(build_manifest(['bee'], {'bee': {}}), os.path.join(self.tmp_dir, 'images.json'))
+
+            watcher = CardDataWatcher(path, log=lambda msg: None)
+            self.assertTrue(watcher.check())
+            self.assertEqual(len(Card.STORE), 2)
+            self.assertEqual(Card.IMAGE_MANIFEST, {Card.CARD_IMAGE_BASE_URL.format('bee'): True})
+            self.assertFalse(watcher.check())
+
+            # Nothing changed since the cards were loaded, so there's nothing to do
+            Card.preload_card_data(path)
+            self.assertFalse(CardDataWatcher(path, log=lambda msg: None).check())
+        finally:
+            Card.preload_card_data()
+
+    def test_image_manifest(self):
+        path = self._write_cards('Bee', 'Wasp', 'Hornet')
+        images = os.path.join(self.tmp_dir, 'images')
+        os.mkdir(images)
+        with open(os.path.join(images, 'bee.png'), 'wb') as f:
+            f.write(b'bzz')
+
+        manifest = build_manifest(['bee', 'wasp'], *scan_directory(['bee', 'wasp'], images))
+        self.assertEqual(manifest['images'], {'bee': {'size': 3, 'sha1': hashlib.sha1(b'bzz').hexdigest()}})
+        self.assertEqual(manifest['missing'], ['wasp'])
+        save_manifest(manifest, os.path.join(self.tmp_dir, 'images.json'))
+
+        checked = []
+        check_img = Card._check_img
+        Card._check_img = staticmethod(lambda url: checked.append(url) or True)
+        try:
+            Card.preload_card_data(path)
+            # Hornet is newer than the manifest, so it's the only one that's checked
+            cards = Card.get_info_many(['bee', 'wasp', 'hornet'])
+            self.assertEqual([c.img_url for c in cards], [Card.CARD_IMAGE_BASE_URL.format('bee'),
+                                                          Card.CARD_IMAGE_404_URL,
+                                                          Card.CARD_IMAGE_BASE_URL.format('hornet')])
+            self.assertEqual(checked, [Card.CARD_IMAGE_BASE_URL.format('hornet')])
+
+            # Without a manifest, or with one made for another image host, every image is checked live
+            Card.load_image_manifest(os.path.join(self.tmp_dir, 'nope.json'))
+            self.assertEqual(Card.IMAGE_MANIFEST, {})
+            other = os.path.join(self.tmp_dir, 'other.json')
+            save_manifest(dict(manifest, base_url='http://example.com/{}.png'), other)
+            Card.load_image_manifest(other)
+            self.assertEqual(Card.IMAGE_MANIFEST, {})
+        finally:
+            Card._check_img = check_img
+            Card.preload_card_data()
+
+    def test_compiled_cards(self):
+        path = self._write_cards('Bee')
+        output = compile_cards(path)
+        with open(path, 'rb') as f:
+            raw = f.read()
+        store = load_compiled(raw, output, Card._code_digest())
+        self.assertEqual([r.name for r in store], ['Bee'])
+        self.assertEqual(store.find_prefix('be'), (1, 0))
+
+        # Changing the code the records were built with makes it stale too, or they'd keep the old image urls
+        base_url = Card.CARD_IMAGE_BASE_URL
+        Card.CARD_IMAGE_BASE_URL = 'https://example.com/{}.png'
+        try:
+            self.assertIsNone(load_compiled(raw, output, Card._code_digest()))
+        finally:
+            Card.CARD_IMAGE_BASE_URL = base_url
+
+        # Editing the JSON makes the compiled database stale, so the JSON is loaded instead
+        self._write_cards('Bee', 'Beehive')
+        with open(path, 'rb') as f:
+            self.assertIsNone(load_compiled(f.read(), output, Card._code_digest()))
+        try:
+            Card.preload_card_data(path)
+            self.assertEqual(len(Card.STORE), 2)
+        finally:
+            Card.preload_card_data()
+
+    def test_checkpoint(self):
+        path = os.path.join(self.tmp_dir, 'checkpoint.log')
+        checkpoint = Checkpoint(path, capacity=3, compact_every=100)
+        fetcher = StreamFetcher(lambda params, limit: [])
+        checkpoint.track('comments', fetcher)
+        for id in ['a', 'b', 'c', 'd']:
+            checkpoint.add(id)
+        checkpoint.add_pending('comment', FakeThing('e', '{{Tyr}}'), ['Tyr'], 'Tyr!')
+        checkpoint.add_pending('comment', FakeThing('f', '{{Tyr}}'), ['Tyr'], 'Tyr!')
+        checkpoint.add('f')
+        fetcher.cursor, fetcher.high_water = 't1_f', 123
+        checkpoint.save()
+        checkpoint.close()
+        # A crash in the middle of a write leaves half a line behind
+        with open(path, 'a') as f:
+            f.write('{"op": "done", "i')
+
+        restarted = Checkpoint(path, capacity=3)
+        self.assertEqual(restarted.replayed, 8)
+        self.assertEqual(list(restarted), ['c', 'd', 'f'])
+        self.assertEqual(list(restarted.pending), ['e'])
+        self.assertEqual(restarted.pending['e']['response'], 'Tyr!')
+        fetcher = StreamFetcher(lambda params, limit: [])
+        restarted.track('comments', fetcher)
+        self.assertEqual((fetcher.cursor, fetcher.high_water), ('t1_f', 123))
+        # Loading compacts the log down to what still matters
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        restarted.close()
+
+    def test_seen_set(self):
+        path = os.path.join(self.tmp_dir, 'seen.json')
+        seen = SeenSet(capacity=3, path=path)
+        for id in ['a', 'b', 'c', 'a', 'd']:
+            seen.add(id)
+        self.assertNotIn('a', seen)
+        self.assertEqual(list(seen), ['b', 'c', 'd'])
+        self.assertEqual(seen.stats(), {'size': 3, 'capacity': 3, 'added': 4, 'evicted': 1, 'eviction_rate': 0.25})
+
+        seen.save()
+        self.assertEqual(list(SeenSet(capacity=2, path=path)), ['c', 'd'])
+
+
+class TestBuildResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = TESLCardBot(author='TestBuildResponse', target_sub='TESLCardBotTesting', lookup_timeout=0.5)
+        self.image_cache = Card.IMAGE_CACHE
+        self.check_img = Card._check_img
+        self.response_cache = TESLCardBot.RESPONSE_CACHE
+        Card.IMAGE_CACHE = ImageCache()
+        TESLCardBot.RESPONSE_CACHE = LRUCache()
+        Card.preload_card_data()
+
+    def tearDown(self):
+        Card.IMAGE_CACHE = self.image_cache
+        Card._check_img = self.check_img
+        TESLCardBot.RESPONSE_CACHE = self.response_cache
+
+    def test_get_info_many(self):
+        checked = []
+
+        def check_img(url):
+            checked.append(url)
+            return 'tullius' not in url
+        Card._check_img = staticmethod(check_img)
+
+        cards = Card.get_info_many(['{{Tyr', 'General Tullius', 'tyr', 'Storm Atronach', 'Tyr', 'teslcardbot'])
+        self.assertEqual([c.name if c is not None else None for c in cards],
+                         ['Tyr', 'General Tullius', 'Tyr', None, 'Tyr', 'TESLCardBot'])
+        # Every image is only checked once, no matter how many times the card was mentioned
+        self.assertEqual(sorted(checked), ['http://www.legends-decks.com/img_cards/generaltullius.png',
+                                           'http://www.legends-decks.com/img_cards/tyr.png'])
+        self.assertEqual(cards[1].img_url, Card.CARD_IMAGE_404_URL)
+        self.assertEqual(Card.get_info_many([]), [])
+
+    def test_response_cache(self):
+        Card._check_img = staticmethod(lambda url: True)
+        first = self.bot.build_response(['Tyr', 'Storm Atronach'])
+        # Same cards by different names, so the table is reused
+        second = self.bot.build_response(['tyr', 'Storm Atronach'])
+        self.assertEqual(TESLCardBot.RESPONSE_CACHE.stats(), {'size': 1, 'hits': 1, 'misses': 1})
+        self.assertEqual(first.split('**Did you know?**')[0], second.split('**Did you know?**')[0])
+        # The cards that weren't found are part of the table
+        self.assertIn('_Storm Atronachs._', self.bot.build_response(['Tyr', 'Storm Atronachs']))
+        self.assertEqual(TESLCardBot.RESPONSE_CACHE.stats()['size'], 2)
+
+    def test_resolution_order(self):
+        def check_img(url):
+            # Resolve the first card last
+            time.sleep(0.2 if 'tyr' in url else 0)
+            return True
+        Card._check_img = staticmethod(check_img)
+
+        response = self.bot.build_response(['Tyr', 'Storm Atronach', 'General Tullius'])
+        self.assertLess(response.index(' Tyr |'), response.index(' General Tullius |'))
+        self.assertIn('were not matched: _Storm Atronach._', response)
+
+    def test_resolution_deadline(self):
+        def check_img(url):
+            time.sleep(2)
+            return False
+        Card._check_img = staticmethod(check_img)
+
+        start = time.time()
+        response = self.bot.build_response(['Tyr'])
+        self.assertLess(time.time() - start, 1.5)
+        # The image check was skipped, so the card keeps its unverified image
+        self.assertIn('(http://www.legends-decks.com/img_cards/tyr.png) Tyr |', response)
+
+        # The deadline is for the whole comment, not for each query in it
+        start = time.time()
+        response = self.bot.build_response(['General Tullius', '? legendary dark elf', '? legendary nord'])
+        self.assertLess(time.time() - start, 1)
+        self.assertIn(' General Tullius |', response)
+        self.assertIn(' Queen Barenziah |', response)
+
+    def test_query_response(self):
+        Card._check_img = staticmethod(lambda url: True)
+        self.assertEqual(TESLCardBot.find_card_mentions('{{? legendary dark elf}} and {{Tyr}}'),
+                         ['? legendary dark elf', 'Tyr'])
+        response = self.bot.build_response(['? legendary dark elf', 'Tyr'])
+        self.assertIn(' Queen Barenziah |', response)
+        self.assertIn(' Tyr |', response)
+        self.assertNotIn('were not matched', response)
+
+        response = self.bot.build_response(['?creatures'])
+        self.assertEqual(response.count('\n[📷]('), TESLCardBot.MAX_QUERY_RESULTS)
+        self.assertIn('Showing 10 of the', response)
+        self.assertIn('No cards match _12-cost items_.', self.bot.build_response(['? 12-cost items']))
+        response = self.bot.build_response(['? bees', 'Storm Atronach'])
+        self.assertIn('I couldn\'t understand _bees_.', response)
+        self.assertIn('none of the cards you mentioned were matched', response)
+
+
+class FakeThing:
+    def __init__(self, id, text, author='someone'):
+        self.id = id
+        self.title = id
+        self.selftext = text
+        self.body = text
+        self.author = author
+        self.fullname = 't1_{}'.format(id)
+        self.saved = False
+        self.replies = []
+
+    def reply(self, response):
+        self.replies.append(response)
+
+    add_comment = reply
+
+    def save(self):
+        self.saved = True
+
+
+class FakeReddit:
+    def __init__(self, submissions, comments):
+        self.submissions = submissions
+        self.comments = comments
+        self.polls = 0
+        self.engine = None
+
+    def get_subreddit(self, name):
+        return self
+
+    def get_new(self, limit, params=None):
+        self.polls += 1
+        if self.polls > 1 and self.engine is not None:
+            self.engine.stop()
+        return listing(self.submissions, limit, params)
+
+    def get_comments(self, subreddit, limit=None, params=None):
+        return listing(self.comments, limit, params)
+
+
+def reddit_page(things, params):
+    # A single request, newest first like Reddit. Returns the page and the 'after' of the next one.
+    things = list(reversed(things))
+    fullnames = [t.fullname for t in things]
+    size = params.get('limit', 25)
+    if 'after' in params:
+        i = fullnames.index(params['after']) + 1 if params['after'] in fullnames else len(things)
+        page = things[i:i + size]
+    elif 'before' in params:
+        # Reddit returns the items right before the cursor
+        i = fullnames.index(params['before']) if params['before'] in fullnames else 0
+        page = things[max(0, i - size):i]
+    else:
+        page = things[:size]
+    older = len(page) > 0 and fullnames.index(page[-1].fullname) < len(things) - 1
+    return page, page[-1].fullname if older else None
+
+
+def listing(things, limit, params):
+    # Works like praw's get_content, which keeps following 'after' until it has limit items. With limit=0 it makes a
+    # single request instead.
+    params = dict(params or {})
+    if limit > 0:
+        params['limit'] = limit
+    found = []
+    while True:
+        page, after = reddit_page(things, params)
+        found.extend(page)
+        if limit <= 0 or len(found) >= limit or after is None:
+            return found if limit <= 0 else found[:limit]
+        params['after'] = after
+
+
+class TestStreamFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.things = []
+        self.pages = []
+        self.added = 0
+
+    def fetch(self, params, limit):
+        self.pages.append(params.get('before'))
+        # One page per call, the way the bot asks praw for it
+        return listing(self.things, 0, dict(params, limit=limit))
+
+    def add(self, count):
+        for _ in range(count):
+            thing = FakeThing('c{}'.format(self.added), '')
+            thing.created_utc = self.added
+            self.things.append(thing)
+            self.added += 1
+
+    def test_pages_forward(self):
+        fetcher = StreamFetcher(self.fetch, page_size=3)
+        self.add(5)
+        # The first poll only looks at the newest page
+        self.assertEqual([t.id for t in fetcher.poll()], ['c2', 'c3', 'c4'])
+        self.assertEqual(list(fetcher.poll()), [])
+        # A burst bigger than a page is fetched one page at a time, oldest first
+        self.add(7)
+        self.pages = []
+        self.assertEqual([t.id for t in fetcher.poll()], ['c{}'.format(i) for i in range(5, 12)])
+        self.assertEqual(self.pages, ['t1_c4', 't1_c7', 't1_c10'])
+        self.assertEqual((fetcher.cursor, fetcher.high_water), ('t1_c11', 11))
+
+    def test_cursor_waits_for_processing(self):
+        fetcher = StreamFetcher(self.fetch, page_size=3)
+        self.add(1)
+        list(fetcher.poll())
+        self.add(2)
+        items = fetcher.poll()
+        next(items)
+        # Processing c1 blew up, so it's fetched again next time
+        self.assertEqual(fetcher.cursor, 't1_c0')
+        self.assertEqual([t.id for t in fetcher.poll()], ['c1', 'c2'])
+
+    def test_single_request_per_page(self):
+        # A short page must not make praw carry on past the cursor, into items that were already handed out
+        reddit = FakeReddit(self.things, [])
+        submissions, comments = TESLCardBot._fetchers(reddit, reddit, batch_limit=10)
+        self.add(3)
+        self.assertEqual([t.id for t in submissions.poll()], ['c0', 'c1', 'c2'])
+        self.add(2)
+        self.assertEqual([t.id for t in submissions.poll()], ['c3', 'c4'])
+        self.assertEqual(list(submissions.poll()), [])
+
+    def test_resync(self):
+        fetcher = StreamFetcher(self.fetch, page_size=3, resync_every=2)
+        self.add(2)
+        list(fetcher.poll())
+        # The item the cursor points to is deleted, so Reddit has nothing before it anymore
+        del self.things[1]
+        self.add(1)
+        self.assertEqual(list(fetcher.poll()), [])
+        self.assertEqual([t.id for t in fetcher.poll()], ['c2'])
+        self.assertEqual(fetcher.cursor, 't1_c2')
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('REDDIT_USERNAME', 'TESLCardBot')
+        self.image_cache = Card.IMAGE_CACHE
+        self.check_img = Card._check_img
+        Card.IMAGE_CACHE = ImageCache()
+        Card._check_img = staticmethod(lambda url: True)
+        Card.preload_card_data()
+
+    def tearDown(self):
+        Card.IMAGE_CACHE = self.image_cache
+        Card._check_img = self.check_img
+
+    def test_adaptive_interval(self):
+        interval = AdaptiveInterval(minimum=1, maximum=5, factor=2)
+        self.assertEqual([interval.update(busy) for busy in [False, False, False, True, False]], [2, 4, 5, 1, 2])
+
+    def test_engine(self):
+        submissions = [FakeThing('s1', 'About {{Tyr}}'), FakeThing('s2', 'No cards here')]
+        comments = [FakeThing('c1', '{{General Tullius}} and {{tyr}}'),
+                    FakeThing('c2', '{{Tyr}}', author=os.environ['REDDIT_USERNAME'])]
+        reddit = FakeReddit(submissions, comments)
+
+        bot = TESLCardBot(author='TestAsyncEngine', target_sub='TESLCardBotTesting')
+        bot._get_praw_instance = lambda: reddit
+        engine = AsyncEngine(bot, min_interval=0.01, max_interval=0.01)
+        reddit.engine = engine
+        engine.start()
+
+        self.assertEqual(len(submissions[0].replies), 1)
+        self.assertIn(' Tyr |', submissions[0].replies[0])
+        self.assertIn(' General Tullius |', comments[0].replies[0])
+        self.assertEqual([len(t.replies) for t in submissions + comments], [1, 0, 1, 0])
+        self.assertTrue(all(t.id in engine.already_done for t in submissions + comments))
+
+    def test_engine_checkpoint(self):
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint.log')
+        try:
+            checkpoint = Checkpoint(path)
+            checkpoint.add_pending('comment', FakeThing('c0', '{{Tyr}}'), ['Tyr'], 'Tyr!')
+            checkpoint.close()
+
+            comments = [FakeThing('c0', '{{Tyr}}'), FakeThing('c1', '{{Tyr}}')]
+            reddit = FakeReddit([], comments)
+            reddit.get_info = lambda thing_id: comments[0]
+            bot = TESLCardBot(author='TestAsyncEngine', target_sub='TESLCardBotTesting')
+            bot._get_praw_instance = lambda: reddit
+            engine = AsyncEngine(bot, min_interval=0.01, max_interval=0.01, checkpoint_path=path)
+            reddit.engine = engine
+            engine.start()
+            engine.already_done.close()
+
+            # The reply that was pending before the restart was posted as it was
+            self.assertEqual(comments[0].replies, ['Tyr!'])
+            self.assertEqual(len(comments[1].replies), 1)
+            restarted = Checkpoint(path)
+            self.assertEqual(sorted(restarted), ['c0', 'c1'])
+            self.assertEqual(len(restarted.pending), 0)
+            self.assertEqual(restarted.cursors['comments'][0], 't1_c1')
+            restarted.close()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_engine_checkpoint_crash(self):
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint.log')
+        try:
+            checkpoint = Checkpoint(path)
+            checkpoint.add('c0')
+            fetcher = StreamFetcher(None)
+            fetcher.cursor = 't1_c0'
+            checkpoint.track('comments', fetcher)
+            checkpoint.save()
+            checkpoint.close()
+
+            comments = [FakeThing('c0', '{{Tyr}}'), FakeThing('c1', '{{Tyr}}'), FakeThing('c2', '{{Tyr}}')]
+            reddit = FakeReddit([], comments)
+            reddit.get_info = lambda thing_id: {c.fullname: c for c in comments}[thing_id]
+            bot = TESLCardBot(author='TestAsyncEngine', target_sub='TESLCardBotTesting')
+            bot._get_praw_instance = lambda: reddit
+            comment_mentions = bot._comment_mentions
+
+            def crash(c):
+                if c.id == 'c1':
+                    raise RuntimeError('Crashed while looking up c1')
+                return comment_mentions(c)
+            bot._comment_mentions = crash
+            engine = AsyncEngine(bot, lookup_workers=1, min_interval=0.01, max_interval=0.01, checkpoint_path=path)
+            reddit.engine = engine
+            self.assertRaises(RuntimeError, engine.start)
+            engine.already_done.close()
+
+            # c2 was fetched along with c1, but the checkpoint doesn't get past c1 until it's been handled
+            restarted = Checkpoint(path)
+            self.assertEqual(restarted.cursors['comments'][0], 't1_c0')
+            restarted.close()
+
+            bot._comment_mentions = comment_mentions
+            reddit.polls = 0
+            engine = AsyncEngine(bot, min_interval=0.01, max_interval=0.01, checkpoint_path=path)
+            reddit.engine = engine
+            engine.start()
+            engine.already_done.close()
+            self.assertEqual([len(c.replies) for c in comments], [0, 1, 1])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FlakyThing(FakeThing):
+    def __init__(self, id, created_utc, errors=()):
+        FakeThing.__init__(self, id, '{{Tyr}}')
+        self.created_utc = created_utc
+        self.errors = list(errors)
+
+    def reply(self, response):
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        FakeThing.reply(self, response)
+
+
+class TestReplyQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.done = []
+        self.bot = TESLCardBot(author='TestReplyQueue', target_sub='TESLCardBotTesting')
+        self.bot.log = lambda msg: None
+        self.queue = ReplyQueue(self.bot, on_done=self.done.append, retry_delay=5, clock=self.clock,
+                                bucket=TokenBucket(rate=1, capacity=2, clock=self.clock))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=0.5, capacity=2, clock=self.clock)
+        self.assertEqual([bucket.take(), bucket.take(), bucket.take()], [0, 0, 2])
+        self.clock.now = 2
+        self.assertEqual(bucket.take(), 0)
+        bucket.pause(10)
+        self.clock.now = 11
+        self.assertEqual(bucket.take(), 1)
+        self.clock.now = 14
+        self.assertEqual(bucket.take(), 0)
+
+    def test_oldest_first(self):
+        things = [FlakyThing('new', 200), FlakyThing('old', 100), FlakyThing('older', 50)]
+        for t in things:
+            self.queue.put('comment', t, ['Tyr'], 'Tyr!')
+        self.queue.put('comment', things[0], ['Tyr'], 'Tyr!')
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual([self.queue.post_next(), self.queue.post_next()], [0, 0])
+        # Out of tokens
+        self.assertEqual(self.queue.post_next(), 1)
+        self.clock.now = 1
+        self.assertEqual(self.queue.post_next(), 0)
+        self.assertEqual([t.id for t in self.done], ['older', 'old', 'new'])
+        self.assertTrue(all(t.saved and len(t.replies) == 1 for t in things))
+        self.assertIsNone(self.queue.post_next())
+
+    def test_rate_limited(self):
+        error = praw.errors.RateLimitExceeded('RATELIMIT', 'try again in 30 seconds', None, {'ratelimit': 30})
+        thing = FlakyThing('c1', 100, errors=[error])
+        self.queue.put('comment', thing, ['Tyr'], 'Tyr!')
+        self.queue.post_next()
+        self.assertEqual(self.done, [])
+        self.assertIn('c1', self.queue)
+        self.assertEqual(self.queue.post_next(), 30)
+        self.clock.now = 31
+        self.queue.post_next()
+        self.assertEqual(self.done, [thing])
+        self.assertEqual(thing.replies, ['Tyr!'])
+
+    def test_retries(self):
+        transient = FlakyThing('c1', 100, errors=[praw.errors.HTTPException(None)])
+        permanent = FlakyThing('c2', 200, errors=[praw.errors.Forbidden(None)])
+        self.queue.put('comment', transient, ['Tyr'], 'Tyr!')
+        self.queue.put('comment', permanent, ['Tyr'], 'Tyr!')
+        self.queue.post_next()
+        self.queue.post_next()
+        # The permanent failure is given up on straight away, the other one is retried after a delay
+        self.assertEqual(self.done, [permanent])
+        self.assertFalse(permanent.saved)
+        self.clock.now = 4
+        self.assertEqual(self.queue.post_next(), 1)
+        self.clock.now = 5
+        self.queue.post_next()
+        self.assertEqual(self.done, [permanent, transient])
+        self.assertEqual(transient.replies, ['Tyr!'])
+        self.assertEqual((self.queue.posted, self.queue.failed), (1, 1))
+
+    def test_failed_save_does_not_post_twice(self):
+        thing = FlakyThing('c1', 100)
+        saves = [praw.errors.HTTPException(None)]
+
+        def save():
+            if len(saves) > 0:
+                raise saves.pop(0)
+            thing.saved = True
+        thing.save = save
+
+        self.queue.put('comment', thing, ['Tyr'], 'Tyr!')
+        self.queue.post_next()
+        self.clock.now = 5
+        self.queue.post_next()
+        self.assertEqual(thing.replies, ['Tyr!'])
+        self.assertTrue(thing.saved)
+        self.assertEqual(self.done, [thing])
+
+    def test_thread(self):
+        self.queue = ReplyQueue(self.bot, on_done=self.done.append).start()
+        try:
+            thing = FlakyThing('c1', 100)
+            self.queue.put('comment', thing, ['Tyr'], 'Tyr!')
+            self.assertTrue(self.queue.join(timeout=5))
+            self.assertEqual(self.done, [thing])
+        finally:
+            self.queue.stop()
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.check_img = Card._check_img
+        Card._check_img = staticmethod(lambda url: True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        Card._check_img = self.check_img
+
+    def test_replay(self):
+        path = os.path.join(self.tmp_dir, 'stream.jsonl')
+        save_stream([ReplayThing('comment', 'c1', '{{Tyr}}', created_utc=2),
+                     ReplayThing('submission', 's1', 'No cards here', created_utc=1),
+                     ReplayThing('comment', 'c2', '{{General Tullius}} {{tyr}}', created_utc=3)], path)
+        things = load_stream(path)
+        self.assertEqual([t.id for t in things], ['c1', 's1', 'c2'])
+
+        bot = TESLCardBot(author='TestReplay', target_sub='TESLCardBotTesting')
+        bot.log = lambda msg: None
+        results = Replay(bot, things, speed=100).run()
+        self.assertEqual((results['items'], results['replies']), (3, 2))
+        self.assertIn(' General Tullius |', things[2].replies[0])
+        self.assertTrue(things[0].saved)
+        self.assertEqual(len(things[1].replies), 0)
+        # Replayed at 100x, the last item arrives 20ms after the first one
+        self.assertGreaterEqual(results['seconds'], 0.02)
+        self.assertEqual(sorted(results['reply_latency_ms']), ['max', 'p50', 'p90', 'p99'])
+
+    def test_saved_submissions(self):
+        path = os.path.join(self.tmp_dir, 'stream.jsonl')
+        save_stream([ReplayThing('submission', 's1', 'What about {{Tyr}}?', created_utc=1)], path)
+        things = load_stream(path)
+        self.assertEqual(things[0].selftext, 'What about {{Tyr}}?')
+        # Streams written by hand might use body for submissions too
+        self.assertEqual(ReplayThing.from_json({'kind': 'submission', 'id': 's2', 'body': '{{Tyr}}'}).selftext,
+                         '{{Tyr}}')
+
+        bot = TESLCardBot(author='TestReplay', target_sub='TESLCardBotTesting')
+        bot.log = lambda msg: None
+        self.assertEqual(Replay(bot, things).run()['replies'], 1)
+        self.assertIn(' Tyr |', things[0].replies[0])
+
+
+def crashing_worker(subs, **kwargs):
+    if 'crashes' in subs:
+        raise SystemExit(1)
+    time.sleep(60)
+
+
+def recording_worker(subs, seen_path=None, **kwargs):
+    with open(seen_path, 'w') as f:
+        json.dump(kwargs, f)
+
+
+def sleeping_start(bot, **kwargs):
+    Card.IMAGE_CACHE.set('tyr.png', True)
+    open(Card.IMAGE_CACHE.path + '.ready', 'w').close()
+    time.sleep(60)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def test_shard(self):
+        self.assertEqual(shard(['a', 'b', 'c', 'd', 'e'], 2), [['a', 'c', 'e'], ['b', 'd']])
+        self.assertEqual(shard(['a'], 3), [['a']])
+
+    def test_backoff(self):
+        supervisor = Supervisor(['a', 'b', 'crashes', 'c'], workers=3, max_restarts=1, backoff=60,
+                                target=crashing_worker)
+        supervisor.log = lambda msg: None
+        self.assertEqual(supervisor.shards, [['a', 'c'], ['b'], ['crashes']])
+        try:
+            for i in range(len(supervisor.shards)):
+                supervisor._spawn(i)
+            healthy = supervisor.processes[:2]
+            supervisor.processes[2].join()
+            supervisor.check()
+            self.assertEqual(supervisor.restarts, [0, 0, 1])
+            supervisor.processes[2].join()
+            supervisor.check()
+            # The failing worker waits before being restarted, and its subreddits stay where they were
+            self.assertEqual(supervisor.shards, [['a', 'c'], ['b'], ['crashes']])
+            self.assertIsNone(supervisor.processes[2])
+            self.assertGreater(supervisor.retry_at[2], time.time() + 50)
+            self.assertEqual(supervisor.processes[:2], healthy)
+            self.assertTrue(all(p.is_alive() for p in healthy))
+
+            supervisor.retry_at[2] = 0
+            supervisor.check()
+            self.assertIsNotNone(supervisor.processes[2])
+        finally:
+            for p in supervisor.processes:
+                if p is not None:
+                    p.terminate()
+
+
+    def test_worker_flushes_image_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'images.json')
+        start = TESLCardBot.start
+        image_cache = Card.IMAGE_CACHE
+        TESLCardBot.start = sleeping_start
+        Card.IMAGE_CACHE = ImageCache(path=path, flush_interval=3600)
+        try:
+            p = Process(target=run_worker, args=(['a'],))
+            p.start()
+            for _ in range(100):
+                if os.path.exists(path + '.ready'):
+                    break
+                time.sleep(0.05)
+            # Stopped like the supervisor or Heroku would, long before the next flush was due
+            p.terminate()
+            p.join()
+            self.assertTrue(ImageCache(path=path).get('tyr.png'))
+        finally:
+            TESLCardBot.start = start
+            Card.IMAGE_CACHE = image_cache
+            shutil.rmtree(tmp_dir)
+
+    def test_worker_options(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            supervisor = Supervisor(['a', 'b'], workers=2, seen_path=os.path.join(tmp_dir, 'seen'), metrics_port=9100,
+                                    metrics_log_interval=60, reload_interval=30, target=recording_worker)
+            supervisor.log = lambda msg: None
+            for i in range(len(supervisor.shards)):
+                supervisor._spawn(i)
+                supervisor.processes[i].join()
+            # Every worker serves its own metrics on its own port
+            for i, sub in enumerate(['a', 'b']):
+                with open(os.path.join(tmp_dir, 'seen.{}'.format(sub))) as f:
+                    kwargs = json.load(f)
+                self.assertEqual((kwargs['metrics_port'], kwargs['metrics_log_interval']), (9100 + i, 60))
+                # Cards are reloaded by the workers themselves, a watcher in the supervisor wouldn't reach them
+                self.assertEqual(kwargs['reload_interval'], 30)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        replies = registry.counter('replies_total', 'Replies.', ['kind'])
+        latency = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+        registry.gauge('queue_depth', 'Queue depth.', function=lambda: [({}, 3)])
+        replies.inc(kind='comment')
+        replies.inc(2, kind='comment')
+        latency.observe(0.5)
+        self.assertEqual(registry.render(), '# HELP replies_total Replies.\n'
+                                            '# TYPE replies_total counter\n'
+                                            'replies_total{kind="comment"} 3.0\n'
+                                            '# HELP latency_seconds Latency.\n'
+                                            '# TYPE latency_seconds histogram\n'
+                                            'latency_seconds_bucket{le="0.1"} 0.0\n'
+                                            'latency_seconds_bucket{le="1.0"} 1.0\n'
+                                            'latency_seconds_bucket{le="+Inf"} 1.0\n'
+                                            'latency_seconds_sum 0.5\n'
+                                            'latency_seconds_count 1.0\n'
+                                            '# HELP queue_depth Queue depth.\n'
+                                            '# TYPE queue_depth gauge\n'
+                                            'queue_depth 3.0\n')
+
+        lines = []
+        MetricsLogger(registry=registry, log=lines.append).log_once()
+        self.assertEqual(lines, ['TESLCardBot metrics # {"latency_seconds": {"": {"count": 1, "sum": 0.5}}, '
+                                 '"queue_depth": {"": 3}, "replies_total": {"comment": 3}}'])
+
+    def test_server(self):
+        check_img = Card._check_img
+        Card._check_img = staticmethod(lambda url: True)
+        server = MetricsServer(port=0).start()
+        try:
+            TESLCardBot(author='TestMetrics').build_response(['Tyr'])
+            body = urlopen('http://127.0.0.1:{}/metrics'.format(server.port)).read().decode('utf-8')
+        finally:
+            server.stop()
+            Card._check_img = check_img
+        self.assertIn('teslcardbot_stage_seconds_count{stage="build_response"}', body)
+        self.assertIn('teslcardbot_stage_seconds_count{stage="get_info"}', body)
+        self.assertIn('teslcardbot_cache_hit_ratio{cache="image"}', body)
+
+
+class FakeImageHost(BaseHTTPRequestHandler):
+    requests_seen = []
+
+    def do_HEAD(self):
+        FakeImageHost.requests_seen.append(self.path)
+        if self.path == '/tyr.png':
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+        elif self.path == '/down.png':
+            self.send_response(503)
+            self.send_header('Content-Type', 'text/html')
+        else:
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        FakeImageHost.requests_seen = []
+        self.server = HTTPServer(('127.0.0.1', 0), FakeImageHost)
+        self.url = 'http://127.0.0.1:{}/{{}}.png'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.http_client = Card.HTTP_CLIENT
+        self.image_cache = Card.IMAGE_CACHE
+        Card.IMAGE_CACHE = ImageCache()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        Card.HTTP_CLIENT = self.http_client
+        Card.IMAGE_CACHE = self.image_cache
+
+    def test_image_exists(self):
+        client = HttpClient(backoff=0)
+        self.assertTrue(client.image_exists(self.url.format('tyr')))
+        self.assertFalse(client.image_exists(self.url.format('nope')))
+        self.assertEqual(FakeImageHost.requests_seen, ['/tyr.png', '/nope.png'])
+
+    def test_retries_and_circuit_breaker(self):
+        client = HttpClient(retries=2, backoff=0, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60))
+        Card.HTTP_CLIENT = client
+        self.assertFalse(Card._img_exists(self.url.format('down')))
+        self.assertEqual(len(FakeImageHost.requests_seen), 3)
+        # The host is considered down, so nothing else is requested until the circuit resets
+        self.assertFalse(Card._img_exists(self.url.format('tyr')))
+        self.assertEqual(len(FakeImageHost.requests_seen), 3)
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+        # Failures are not cached, the image is checked again once the host is back up
+        client.breaker.reset_timeout = 0
+        self.assertTrue(Card._img_exists(self.url.format('tyr')))
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= 60
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # A single trial request goes through, everything else waits for its outcome
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+
+class TestImports(unittest.TestCase):
+    IMPORT_SCRIPT = 'import time, sys, json\n' \
+                    'start = time.perf_counter()\n' \
+                    'import {}\n' \
+                    'print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))\n'
+
+    def _import(self, module):
+        # A fresh interpreter, since this one has already imported everything
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        out = subprocess.check_output([sys.executable, '-c', self.IMPORT_SCRIPT.format(module)], cwd=root,
+                                      stderr=subprocess.DEVNULL)
+        seconds, modules = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        print('Importing {} took {:.1f}ms'.format(module, seconds * 1000))
+        return modules
+
+    def test_card_without_network(self):
+        for module in ['teslcardbot.card', 'teslcardbot.bot']:
+            modules = self._import(module)
+            self.assertNotIn('praw', modules)
+            self.assertNotIn('requests', modules)
+
+
 if __name__ == '__main__':
     unittest.main()